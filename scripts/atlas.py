@@ -0,0 +1,176 @@
+import compositor
+import json
+import math
+import numpy as np
+import os
+
+
+INDEX_VERSION = 1
+MAX_PAGE_SIZE = 4096
+PADDING = 1
+
+class TrimmedFrame:
+    def __init__(self, col, row, pixels):
+        self.col = col
+        self.row = row
+        alpha_rows = np.flatnonzero(pixels[:, :, 3].any(axis=1))
+        alpha_cols = np.flatnonzero(pixels[:, :, 3].any(axis=0))
+        if alpha_rows.size == 0:
+            # fully transparent frame, nothing to pack
+            self.left, self.top, self.width, self.height = 0, 0, 0, 0
+        else:
+            self.left = int(alpha_cols[0])
+            self.top = int(alpha_rows[0])
+            self.width = int(alpha_cols[-1]) + 1 - self.left
+            self.height = int(alpha_rows[-1]) + 1 - self.top
+        self.pixels = pixels[self.top:self.top + self.height, self.left:self.left + self.width]
+        self.page = None
+        self.x = 0
+        self.y = 0
+
+    def is_empty(self):
+        return self.width == 0 or self.height == 0
+
+class Page:
+    def __init__(self, shelf_width, max_size):
+        self.shelf_width = shelf_width
+        self.max_size = max_size
+        self.shelf_y = 0
+        self.shelf_height = 0
+        self.cursor_x = 0
+        self.used_width = 0
+        self.used_height = 0
+        self.frames = []
+
+    def try_insert(self, frame):
+        width = frame.width + PADDING
+        height = frame.height + PADDING
+        if self.cursor_x + width > self.shelf_width:
+            # open a new shelf below the current one
+            self.shelf_y += self.shelf_height
+            self.shelf_height = 0
+            self.cursor_x = 0
+        if self.shelf_y + height > self.max_size or width > self.shelf_width:
+            return False
+        frame.x = self.cursor_x
+        frame.y = self.shelf_y
+        self.cursor_x += width
+        self.shelf_height = max(self.shelf_height, height)
+        self.used_width = max(self.used_width, frame.x + frame.width)
+        self.used_height = max(self.used_height, frame.y + frame.height)
+        self.frames.append(frame)
+        return True
+
+    def get_size(self):
+        return next_power_of_two(self.used_width), next_power_of_two(self.used_height)
+
+def next_power_of_two(value):
+    power = 1
+    while power < value:
+        power *= 2
+    return power
+
+def trim_frames(cells, width, height):
+    frames = []
+    for col, row, image_path in cells:
+        print(f'image_path: {image_path}')
+        pixels = compositor.load_frame(image_path, width, height)
+        frames.append(TrimmedFrame(col, row, pixels))
+    return frames
+
+def pack_frames(frames, max_page_size=MAX_PAGE_SIZE):
+    # shelf packing with frames sorted by decreasing height
+    to_pack = sorted(
+        (frame for frame in frames if not frame.is_empty()),
+        key=lambda frame: (frame.height, frame.width),
+        reverse=True,
+    )
+    # aim for roughly square pages instead of one long strip
+    total_area = sum((frame.width + PADDING) * (frame.height + PADDING) for frame in to_pack)
+    widest = max((frame.width + PADDING for frame in to_pack), default=1)
+    shelf_width = min(max(next_power_of_two(math.isqrt(total_area)), widest), max_page_size)
+    pages = [Page(shelf_width, max_page_size)]
+    for frame in to_pack:
+        if not pages[-1].try_insert(frame):
+            pages.append(Page(shelf_width, max_page_size))
+            if not pages[-1].try_insert(frame):
+                raise ValueError(f'frame {frame.col},{frame.row} does not fit in a {max_page_size} page')
+        frame.page = len(pages) - 1
+    return pages
+
+def compose_page(page):
+    page_width, page_height = page.get_size()
+    pixels = np.zeros((page_height, page_width, 4), dtype=np.uint8)
+    for frame in page.frames:
+        pixels[frame.y:frame.y + frame.height, frame.x:frame.x + frame.width] = frame.pixels
+    return pixels
+
+def build_index(frames, pages, page_filenames, cell_width, cell_height, is_animation):
+    page_sizes = [page.get_size() for page in pages]
+    index_frames = []
+    for frame in sorted(frames, key=lambda frame: (frame.row, frame.col)):
+        index_frame = {
+            "row": frame.row,
+            "col": frame.col,
+            "page": frame.page,
+            "rect": [frame.x, frame.y, frame.width, frame.height],
+            "uv": [0.0, 0.0, 0.0, 0.0],
+            # top left corner of the trimmed rect inside the full SpriteSize cell
+            "offset": [frame.left, frame.top],
+        }
+        if frame.page is not None:
+            page_width, page_height = page_sizes[frame.page]
+            index_frame["uv"] = [
+                frame.x / page_width,
+                frame.y / page_height,
+                (frame.x + frame.width) / page_width,
+                (frame.y + frame.height) / page_height,
+            ]
+        index_frames.append(index_frame)
+    return {
+        "version": INDEX_VERSION,
+        "cell_size": [cell_width, cell_height],
+        "is_animation": is_animation,
+        "pages": [
+            {"file": page_filename, "size": list(page_size)}
+            for page_filename, page_size in zip(page_filenames, page_sizes)
+        ],
+        "frames": index_frames,
+    }
+
+def make_atlas(cells, cell_width, cell_height, is_animation, sheet_file_path):
+    # sheet_file_path is the path of the grid sheet, the pages and the index are
+    # written next to it as <name>_atlas_<page>.png and <name>_atlas.json
+    frames = trim_frames(cells, cell_width, cell_height)
+    pages = pack_frames(frames)
+
+    base_path = os.path.splitext(sheet_file_path)[0]
+    page_paths = []
+    for page_id, page in enumerate(pages):
+        page_path = f'{base_path}_atlas_{page_id}.png'
+        print(f'page_path: {page_path}')
+        compositor.save_sheet(compose_page(page), page_path)
+        page_paths.append(page_path)
+
+    index = build_index(
+        frames,
+        pages,
+        [os.path.basename(page_path) for page_path in page_paths],
+        cell_width,
+        cell_height,
+        is_animation,
+    )
+    index_path = f'{base_path}_atlas.json'
+    print(f'index_path: {index_path}')
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+    return page_paths + [index_path]
+
+def list_atlas_files(sheet_file_path):
+    base_path = os.path.splitext(sheet_file_path)[0]
+    index_path = f'{base_path}_atlas.json'
+    with open(index_path, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    sheet_dir = os.path.dirname(sheet_file_path)
+    page_paths = [os.path.join(sheet_dir, page["file"]) for page in index["pages"]]
+    return page_paths + [index_path]
@@ -0,0 +1,264 @@
+import argparse
+import bpy
+import common
+import construction
+import export_moving_smoke
+import export_static_smoke
+import json
+import math
+import os
+import pathlib
+import platform
+import render_animation
+import render_industry_constructions
+import sheet
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+ANIMATION_ITEM = "locomotive"
+CONSTRUCTION_ITEM = "steel_works"
+DEFAULT_OUTPUT = "benchmark_results.json"
+RESULTS_VERSION = 1
+SHEET_CAMERA = "Camera"
+
+def reset_scene():
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    return bpy.context.scene
+
+def setup_fast_render(scene, item):
+    # Cycles on the CPU with one sample: slow engines would hide the pipeline costs
+    sprite = common.SpriteSize(item)
+    scene.render.engine = 'CYCLES'
+    scene.cycles.device = 'CPU'
+    scene.cycles.samples = 1
+    scene.cycles.use_denoising = False
+    scene.render.resolution_x = sprite.width
+    scene.render.resolution_y = sprite.height
+    scene.render.resolution_percentage = 100
+    scene.render.film_transparent = True
+    scene.render.image_settings.file_format = 'PNG'
+    scene.render.image_settings.color_mode = 'RGBA'
+
+def add_empty(scene, name, location=(0, 0, 0), parent=None, collection=None):
+    empty = bpy.data.objects.new(name, None)
+    empty.location = location
+    empty.parent = parent
+    (collection or scene.collection).objects.link(empty)
+    return empty
+
+def add_camera(scene, name):
+    camera_data = bpy.data.cameras.new(name)
+    camera_data.type = 'ORTHO'
+    camera_data.ortho_scale = 8
+    camera = bpy.data.objects.new(name, camera_data)
+    # isometric view, like the game
+    camera.location = (10, -10, 10)
+    camera.rotation_euler = (math.radians(60), 0, math.radians(45))
+    scene.collection.objects.link(camera)
+    scene.camera = camera
+    return camera
+
+def add_light(scene):
+    light = bpy.data.objects.new('Sun', bpy.data.lights.new('Sun', 'SUN'))
+    light.rotation_euler = (math.radians(45), 0, math.radians(30))
+    scene.collection.objects.link(light)
+
+def add_mesh_collection(scene, name, density, origin):
+    # density x density spheres, their vertex count grows with density too
+    collection = bpy.data.collections.new(name)
+    scene.collection.children.link(collection)
+    material = bpy.data.materials.new(f'{name}Material')
+    material.use_nodes = True
+    spacing = 4 / density
+    for x in range(density):
+        for y in range(density):
+            bpy.ops.mesh.primitive_uv_sphere_add(
+                segments=8 + 4 * density,
+                ring_count=4 + 2 * density,
+                radius=spacing / 2,
+                location=(x * spacing - 2 + spacing / 2, y * spacing - 2 + spacing / 2, spacing / 2),
+            )
+            sphere = bpy.context.active_object
+            for users_collection in sphere.users_collection:
+                users_collection.objects.unlink(sphere)
+            collection.objects.link(sphere)
+            sphere.data.materials.append(material)
+            sphere.parent = origin
+    return collection
+
+def build_direction_file(file_path, density, n_frames):
+    scene = reset_scene()
+    setup_fast_render(scene, ANIMATION_ITEM)
+    origin = add_empty(scene, common.EMPTY_ORIGIN)
+    add_camera(scene, export_moving_smoke.CAMERA)
+    add_light(scene)
+    add_mesh_collection(scene, 'Vehicle', density, origin)
+    emitter = add_empty(scene, export_moving_smoke.SMOKE_EMITTER, (0, 0, 2), origin)
+    add_empty(scene, export_moving_smoke.DIRECTION_REFERENCE, (0, 0, 1), emitter)
+    origin.keyframe_insert(data_path='location', frame=1)
+    origin.location.x = 1
+    origin.keyframe_insert(data_path='location', frame=n_frames)
+    bpy.ops.wm.save_as_mainfile(filepath=str(file_path))
+
+def build_construction_file(file_path, density):
+    scene = reset_scene()
+    setup_fast_render(scene, CONSTRUCTION_ITEM)
+    default_collection = bpy.data.collections.new(construction.DEFAULT_COLLECTION)
+    scene.collection.children.link(default_collection)
+    origin = add_empty(scene, common.EMPTY_ORIGIN, collection=default_collection)
+    add_camera(scene, export_static_smoke.CAMERA)
+    add_light(scene)
+    for collection_name in render_industry_constructions.COLLECTIONS[CONSTRUCTION_ITEM]:
+        add_mesh_collection(scene, collection_name, density, origin)
+    emitters = bpy.data.collections.new(export_static_smoke.SMOKE_EMITTERS)
+    scene.collection.children.link(emitters)
+    for index in range(density):
+        add_empty(scene, f'Emitter{index}', (index - density / 2, 0, 3), origin, emitters)
+    bpy.ops.wm.save_as_mainfile(filepath=str(file_path))
+
+def build_sheet_template(file_path):
+    # Sheet.setup_camera_and_meshes expects a 'Camera' and no meshes
+    scene = reset_scene()
+    setup_fast_render(scene, ANIMATION_ITEM)
+    add_camera(scene, SHEET_CAMERA)
+    bpy.ops.wm.save_as_mainfile(filepath=str(file_path))
+
+def build_fixtures(root, sizes, n_frames):
+    blender_dir = root.joinpath('game/blender')
+    models_dir = blender_dir.joinpath(f'{common.MODELS}/{common.WORLD_MAP}')
+    os.makedirs(blender_dir.joinpath(sheet.Sheet.SHEETS), exist_ok=True)
+    build_sheet_template(blender_dir.joinpath(f'{sheet.Sheet.SHEETS}/{sheet.Sheet.TEMPLATE}'))
+    for size in sizes:
+        version = f'bench_{size}'
+        version_dir = models_dir.joinpath(f'{ANIMATION_ITEM}/{version}')
+        os.makedirs(version_dir, exist_ok=True)
+        for directions in export_moving_smoke.DIRECTIONS_MAP:
+            build_direction_file(version_dir.joinpath(f'{version}_{directions}.blend'), size, n_frames)
+        os.makedirs(models_dir.joinpath(CONSTRUCTION_ITEM), exist_ok=True)
+        build_construction_file(models_dir.joinpath(f'{CONSTRUCTION_ITEM}/{version}.blend'), size)
+
+def make_game_repo_dir(root):
+    # get_blender_dir() is three levels up from the current directory
+    repo_dir = root.joinpath('bench/game/repo')
+    os.makedirs(repo_dir, exist_ok=True)
+    return repo_dir
+
+def run_stage(results, name, function):
+    start = time.perf_counter()
+    with common.span(f'benchmark_{name}'):
+        function()
+    results[name] = time.perf_counter() - start
+    print(f'{name}: {results[name]:.3f}s')
+
+def benchmark_size(size, n_frames):
+    version = f'bench_{size}'
+    results = {}
+    common.TRACER.spans.clear()
+
+    renders_dir = common.get_or_create_renders_dir(ANIMATION_ITEM, version)
+    files_to_render = common.find_files_to_render(ANIMATION_ITEM, version)
+    direction_paths = [
+        renders_dir.joinpath(file.split(".")[0][-5:]) for file in files_to_render
+    ]
+    run_stage(results, 'render_directions', lambda: [
+        render_animation.render_blender_file(file, renders_dir, True, n_frames) for file in files_to_render
+    ])
+
+    for backend in sheet.Sheet.BACKENDS:
+        sprite_sheet = sheet.Sheet(
+            item=ANIMATION_ITEM,
+            version=version,
+            render_sheet=True,
+            n_cols=n_frames,
+            n_rows=len(direction_paths),
+            render_dirs=direction_paths,
+            render_filenames=common.prepare_frame_filenames(n_frames),
+            is_animation=True,
+            atlas_kind=render_animation.ATLAS_MOVING,
+            backend=backend,
+        )
+        run_stage(results, f'sheet_{backend}', sprite_sheet.make_render)
+
+    model_path = common.get_model_path(CONSTRUCTION_ITEM, version)
+    construction_dir = common.get_or_create_renders_dir(CONSTRUCTION_ITEM, version)
+    collection_names = render_industry_constructions.COLLECTIONS[CONSTRUCTION_ITEM]
+    for reveal in construction.REVEALS:
+        run_stage(results, f'construction_{reveal}', lambda: construction.render_animations(
+            CONSTRUCTION_ITEM,
+            model_path,
+            construction_dir.joinpath(reveal),
+            0,
+            True,
+            n_frames,
+            collection_names,
+            reveal=reveal,
+        ))
+
+    run_stage(results, 'moving_smoke', lambda: export_moving_smoke.extract_dict_from_target_files(
+        files_to_render, n_frames, ANIMATION_ITEM
+    ))
+    run_stage(results, 'moving_smoke_vectorized', lambda: export_moving_smoke.extract_dict_from_target_files(
+        files_to_render, n_frames, ANIMATION_ITEM, vectorized=True
+    ))
+    run_stage(results, 'static_smoke', lambda: export_static_smoke.extract_dict_from_target_files(
+        model_path, CONSTRUCTION_ITEM
+    ))
+    # the inner stages (open_mainfile, render, load_frame...) of this size
+    return {"stages": results, "spans": common.TRACER.summarize()}
+
+def get_commit():
+    try:
+        completed = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return completed.stdout.strip() or None
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 8], help='mesh density of the synthetic scenes')
+    parser.add_argument('--n_frames', type=int, default=8)
+    parser.add_argument('--output', type=str, default=DEFAULT_OUTPUT, help='where the results JSON is written')
+    parser.add_argument('--keep', action='store_true', help='keep the generated fixtures and renders')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    output_path = os.path.abspath(args.output)
+    root = pathlib.Path(tempfile.mkdtemp(prefix='blender_scripts_benchmark_'))
+    print(f'fixtures: {root}')
+    initial_dir = os.getcwd()
+    try:
+        build_fixtures(root, args.sizes, args.n_frames)
+        os.chdir(make_game_repo_dir(root))
+        results = {
+            "version": RESULTS_VERSION,
+            "commit": get_commit(),
+            "blender": bpy.app.version_string,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "n_frames": args.n_frames,
+            "sizes": {str(size): benchmark_size(size, args.n_frames) for size in args.sizes},
+        }
+    finally:
+        os.chdir(initial_dir)
+        if args.keep:
+            print(f'kept fixtures in {root}')
+        else:
+            shutil.rmtree(root)
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+    print(f'output_path: {output_path}')
+
+
+if __name__ == "__main__":
+    main()
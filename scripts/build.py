@@ -0,0 +1,317 @@
+import argparse
+import common
+import concurrent.futures
+import construction
+import export_moving_smoke
+import export_static_smoke
+import os
+import pathlib
+import pool
+import render_animation
+import render_rotatable_buildings
+import sheet
+import sys
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# stages of each item, every item in common.ITEM_DIMS must be listed
+STAGE_ANIMATION = "animation"
+STAGE_HOUSING = "housing"
+STAGE_INDUSTRY = "industry"
+STAGE_MOVING_SMOKE = "moving_smoke"
+STAGE_ROTATABLE = "rotatable"
+STAGE_STATIC_SMOKE = "static_smoke"
+PIPELINES = {
+    'big_carriage': [STAGE_ANIMATION],
+    'cart': [STAGE_ANIMATION],
+    'city': [STAGE_HOUSING],
+    'coal_mine': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'depot': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'harbour': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'harbour_mask': [STAGE_ROTATABLE],
+    'industrial_farm_with_fields': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'iron_ore_mine': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'local_farm_with_fields': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'locomotive': [STAGE_ANIMATION, STAGE_MOVING_SMOKE],
+    'logging_camp': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'ship': [STAGE_ANIMATION, STAGE_MOVING_SMOKE],
+    'steel_works': [STAGE_INDUSTRY, STAGE_ROTATABLE, STAGE_STATIC_SMOKE],
+    'stonemason': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'suburbs': [STAGE_HOUSING],
+    'town': [STAGE_HOUSING],
+    'train_station': [STAGE_INDUSTRY, STAGE_ROTATABLE],
+    'truck': [STAGE_ANIMATION, STAGE_MOVING_SMOKE],
+    'wagon': [STAGE_ANIMATION],
+}
+# stages whose models are folders of .blend files (versions), the others
+# are single .blend files (filenames) in the item folder
+FOLDER_STAGES = [STAGE_ANIMATION, STAGE_HOUSING, STAGE_MOVING_SMOKE]
+
+class Task:
+    def __init__(self, name, command, inputs, outputs, dependencies, render_profile=None):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.dependencies = dependencies
+        # render_profile: profile of the frames in outputs, None for the other tasks
+        self.render_profile = render_profile
+
+    def has_other_profile(self):
+        # frames rendered with another profile are rebuilt, whatever their mtime
+        for output in self.outputs:
+            render_settings = common.read_render_settings(output)
+            if render_settings and render_settings.profile != self.render_profile:
+                return True
+        return False
+
+    def is_stale(self):
+        # same rule as make: rebuild if an output is missing or older than an input
+        if not self.outputs or not all(os.path.exists(output) for output in self.outputs):
+            return True
+        if self.render_profile and self.has_other_profile():
+            return True
+        newest_input = max(
+            (os.path.getmtime(input) for input in self.inputs if os.path.exists(input)),
+            default=0
+        )
+        oldest_output = min(os.path.getmtime(output) for output in self.outputs)
+        return newest_input > oldest_output
+
+def get_item_models_dir(item):
+    blender_dir = common.get_blender_dir()
+    return blender_dir.joinpath(f'{common.MODELS}/{common.WORLD_MAP}/{item}/')
+
+def find_versions(item):
+    models_dir = get_item_models_dir(item)
+    if not os.path.exists(models_dir):
+        return []
+    return sorted(entry.name for entry in os.scandir(models_dir) if entry.is_dir())
+
+def find_filenames(item):
+    models_dir = get_item_models_dir(item)
+    if not os.path.exists(models_dir):
+        return []
+    return sorted(
+        entry.name[:-len(".blend")] for entry in os.scandir(models_dir)
+        if entry.is_file() and entry.name.endswith(".blend")
+    )
+
+def get_renders_dir(item, version):
+    blender_dir = common.get_blender_dir()
+    return blender_dir.joinpath(f'{common.RENDERS}/{common.WORLD_MAP}/{item}/{version}/')
+
+def get_sprite_sheet_path(item, version, atlas_kind):
+    # same path as Sheet.get_sheet_file_path
+    blender_dir = common.get_blender_dir()
+    return blender_dir.joinpath(f'{sheet.Sheet.SHEETS}/{item}/{atlas_kind}/{item}_{version}.png')
+
+def get_smoke_asset_path(item, version, target_dir, extension):
+    current_dir = pathlib.Path(os.getcwd())
+    return current_dir.joinpath(f'{target_dir}/{item}_{version}.{extension}')
+
+def script_command(script, *arguments):
+    return [sys.executable, os.path.join(SCRIPTS_DIR, script), *[str(argument) for argument in arguments]]
+
+def get_frame_paths(output_dirs, n_frames):
+    filenames = common.prepare_frame_filenames(n_frames)
+    return [str(output_dir.joinpath(filename)) for output_dir in output_dirs for filename in filenames]
+
+def add_render_and_sheet_tasks(tasks, name, script, model_arguments, inputs, render_outputs, sheet_output, render_flag, render_profile, render_dependencies=()):
+    render_name = f'{name}:render'
+    tasks[render_name] = Task(
+        render_name,
+        script_command(script, *model_arguments, render_flag, '--use_cache', '--render_only', '--render_profile', render_profile),
+        inputs,
+        render_outputs,
+        list(render_dependencies),
+        render_profile,
+    )
+    sheet_name = f'{name}:sheet'
+    # the sheet stage also copies the sheet to the repo, like Sheet.make_render_and_copy.
+    # Its output is the sprite_sheets file: the copy in the repo keeps its
+    # mtime when its content is unchanged, and would never look up to date
+    tasks[sheet_name] = Task(
+        sheet_name,
+        script_command(script, *model_arguments, '--render_sheet'),
+        render_outputs,
+        [str(sheet_output)],
+        [render_name],
+    )
+
+def add_item_tasks(tasks, item, n_frames, render_profile):
+    stages = PIPELINES[item]
+    n_frames_arguments = ['--n_frames', n_frames]
+    for version in find_versions(item) if any(stage in FOLDER_STAGES for stage in stages) else []:
+        files = common.find_files_to_render(item, version)
+        renders_dir = get_renders_dir(item, version)
+        if STAGE_ANIMATION in stages:
+            output_dirs = [renders_dir.joinpath(file.split(".")[0][-5:]) for file in files]
+            add_render_and_sheet_tasks(
+                tasks,
+                f'{item}/{version}:{STAGE_ANIMATION}',
+                'render_animation.py',
+                [item, version, *n_frames_arguments],
+                files,
+                get_frame_paths(output_dirs, n_frames),
+                get_sprite_sheet_path(item, version, render_animation.ATLAS_MOVING),
+                '--render_animations',
+                render_profile,
+            )
+        if STAGE_HOUSING in stages:
+            output_dirs = [renders_dir.joinpath(file.split(".")[0][-1:]) for file in files]
+            add_render_and_sheet_tasks(
+                tasks,
+                f'{item}/{version}:{STAGE_HOUSING}',
+                'render_housing_construction.py',
+                [item, version, *n_frames_arguments],
+                files,
+                get_frame_paths(output_dirs, n_frames),
+                get_sprite_sheet_path(item, version, construction.ATLAS_CONSTRUCTION),
+                '--render_animations',
+                render_profile,
+            )
+        if STAGE_MOVING_SMOKE in stages:
+            name = f'{item}/{version}:{STAGE_MOVING_SMOKE}'
+            tasks[name] = Task(
+                name,
+                script_command('export_moving_smoke.py', item, version, *n_frames_arguments),
+                files,
+                [str(get_smoke_asset_path(
+                    item,
+                    version,
+                    export_moving_smoke.SMOKE_DATA_ASSETS,
+                    export_moving_smoke.SMOKE_OUTPUT_EXTENSION,
+                ))],
+                [],
+            )
+
+    for filename in find_filenames(item) if any(stage not in FOLDER_STAGES for stage in stages) else []:
+        model_path = common.get_model_path(item, filename)
+        renders_dir = get_renders_dir(item, filename)
+        # both stages render the same model into the same renders dir and
+        # render_cache.json, so the rotatable render waits for the industry one
+        industry_render = []
+        if STAGE_INDUSTRY in stages:
+            output_dirs = [renders_dir.joinpath(f'{degree}') for degree in common.DEGREES]
+            industry_render.append(f'{item}/{filename}:{STAGE_INDUSTRY}:render')
+            add_render_and_sheet_tasks(
+                tasks,
+                f'{item}/{filename}:{STAGE_INDUSTRY}',
+                'render_industry_constructions.py',
+                [item, filename, *n_frames_arguments],
+                [model_path],
+                get_frame_paths(output_dirs, n_frames),
+                get_sprite_sheet_path(item, filename, construction.ATLAS_CONSTRUCTION),
+                '--render_animations',
+                render_profile,
+            )
+        if STAGE_ROTATABLE in stages:
+            add_render_and_sheet_tasks(
+                tasks,
+                f'{item}/{filename}:{STAGE_ROTATABLE}',
+                'render_rotatable_buildings.py',
+                [item, filename, '--single_session'],
+                [model_path],
+                [str(renders_dir.joinpath(f'{degree:03d}.png')) for degree in common.DEGREES],
+                get_sprite_sheet_path(item, filename, render_rotatable_buildings.ATLAS_VARIETY),
+                '--render_degrees',
+                render_profile,
+                industry_render,
+            )
+        if STAGE_STATIC_SMOKE in stages:
+            name = f'{item}/{filename}:{STAGE_STATIC_SMOKE}'
+            tasks[name] = Task(
+                name,
+                script_command('export_static_smoke.py', item, filename),
+                [model_path],
+                [str(get_smoke_asset_path(
+                    item,
+                    filename,
+                    export_static_smoke.SMOKE_DATA_ASSETS,
+                    export_static_smoke.SMOKE_OUTPUT_EXTENSION,
+                ))],
+                [],
+            )
+
+def make_tasks(items, n_frames, render_profile=common.RENDER_PROFILE_FINAL):
+    tasks = {}
+    for item in items:
+        add_item_tasks(tasks, item, n_frames, render_profile)
+    return tasks
+
+def run_tasks(tasks, n_workers, force, dry_run):
+    done = set()
+    failed = set()
+    skipped = set()
+    running = {}
+    pending = dict(tasks)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while pending or running:
+            # tasks that finish without running can unblock others, so scan until nothing changes
+            changed = True
+            while changed:
+                changed = False
+                for name, task in list(pending.items()):
+                    if any(dependency in failed or dependency in skipped for dependency in task.dependencies):
+                        print(f'skip {name}: a dependency failed')
+                        skipped.add(name)
+                    elif all(dependency in done for dependency in task.dependencies):
+                        if not force and not task.is_stale():
+                            print(f'up to date {name}')
+                            done.add(name)
+                        elif dry_run:
+                            print(f'would run {name}: {" ".join(task.command)}')
+                            done.add(name)
+                        else:
+                            print(f'run {name}')
+                            running[executor.submit(pool.run_command, name, task.command)] = name
+                    else:
+                        continue
+                    del pending[name]
+                    changed = True
+            if not running:
+                if pending:
+                    raise RuntimeError(f'unresolvable dependencies: {", ".join(pending)}')
+                continue
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                result = future.result()
+                if result.succeeded():
+                    print(f'done {name}')
+                    done.add(name)
+                else:
+                    print(f'failed {name} with exit code {result.returncode}:')
+                    print(result.output_tail())
+                    failed.add(name)
+    return done, failed, skipped
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('items', type=str, nargs='*', help='items to build, all of common.ITEM_DIMS if empty')
+    parser.add_argument('--n_frames', type=int, default=24)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of tasks running at the same time')
+    parser.add_argument('--force', action='store_true', help='run every task, even the up to date ones')
+    parser.add_argument('--dry_run', action='store_true', help='only print the tasks that would run')
+    parser.add_argument('--render_profile', type=str, choices=list(common.RENDER_PROFILES), default=common.RENDER_PROFILE_FINAL, help='preview renders fast, and its sheets are never published')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    missing = set(common.ITEM_DIMS) - set(PIPELINES)
+    if missing:
+        raise ValueError(f'items without a pipeline: {", ".join(sorted(missing))}')
+    items = args.items or list(common.ITEM_DIMS)
+    tasks = make_tasks(items, args.n_frames, args.render_profile)
+    print(f'{len(tasks)} tasks for {len(items)} items')
+    done, failed, skipped = run_tasks(tasks, args.workers, args.force, args.dry_run)
+    print(f'done: {len(done)}, failed: {len(failed)}, skipped: {len(skipped)}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
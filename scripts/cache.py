@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+
+
+CACHE_FILENAME = "render_cache.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class RenderCache:
+    # Remembers, per render unit (a direction, a degree or a variety), the key
+    # of the inputs its outputs were rendered from. The key hashes the .blend
+    # contents together with the settings the script applies on top of it.
+    def __init__(self, renders_dir):
+        self.path = os.path.join(renders_dir, CACHE_FILENAME)
+        # file hashes are reused while size and mtime are unchanged
+        self.units, self.files = self.load()
+        # units stored by this process, the others are re-read on save
+        self.stored = set()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}, {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data.get("units", {}), data.get("files", {})
+
+    def hash_file(self, file_path):
+        stat = os.stat(file_path)
+        known = self.files.get(file_path)
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        self.files[file_path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest.hexdigest(),
+        }
+        return digest.hexdigest()
+
+    def make_key(self, blend_path, **settings):
+        digest = hashlib.sha256()
+        digest.update(self.hash_file(blend_path).encode('utf-8'))
+        digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def is_fresh(self, unit, key, output_paths):
+        if self.units.get(unit) != key:
+            return False
+        return all(os.path.exists(output_path) for output_path in output_paths)
+
+    def store(self, unit, key):
+        self.units[unit] = key
+        self.stored.add(unit)
+        self.save()
+
+    def save(self):
+        # another process may have saved since this one loaded: its units are
+        # kept, and the temp file is per process so the renames never collide
+        units, files = self.load()
+        units.update({unit: self.units[unit] for unit in self.stored})
+        files.update(self.files)
+        self.units, self.files = units, files
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"units": self.units, "files": self.files}, f, ensure_ascii=False, indent=4)
+        os.replace(temp_path, self.path)
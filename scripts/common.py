@@ -1,7 +1,9 @@
-import bpy
+import contextlib
 import os
 import json
 import pathlib
+import threading
+import time
 
 
 BLENDER = "game/blender/"
@@ -30,7 +32,28 @@ ITEM_DIMS = {
     'wagon': [1, 1, 1],
 }
 MODELS = """3d models"""
+RENDER_METADATA = "render.json"
+RENDER_PROFILE_FINAL = "final"
+RENDER_PROFILE_PREVIEW = "preview"
+# publish: whether sheets made from these renders may go into the game repo.
+# The other keys override the .blend settings, final keeps them all.
+RENDER_PROFILES = {
+    RENDER_PROFILE_FINAL: {
+        "publish": True,
+    },
+    RENDER_PROFILE_PREVIEW: {
+        "publish": False,
+        # the first one this Blender version has
+        "engines": ['BLENDER_EEVEE_NEXT', 'BLENDER_EEVEE', 'BLENDER_WORKBENCH'],
+        "samples": 4,
+        "use_denoising": False,
+        "resolution_percentage": 50,
+        # 0: one per core
+        "threads": 0,
+    },
+}
 RENDERS = "renders"
+TRACES = "traces"
 WORLD_MAP = "world_map"
 
 class SpriteSize:
@@ -65,6 +88,174 @@ class SpriteSize:
         sprite_height = (sprite_width / 2) + (self.TILE_HEIGHT * z)
         return sprite_height
 
+class RenderSettings:
+    # Settings the render scripts apply on top of what is stored in the .blend,
+    # right after open_mainfile. They are part of the render cache keys and
+    # travel to the workers as a dict.
+    def __init__(self, resolution=None, profile=RENDER_PROFILE_FINAL):
+        # resolution: (width, height) of the rendered frames, None keeps the .blend one
+        self.resolution = resolution
+        # profile: one of RENDER_PROFILES
+        self.profile = profile
+
+    @classmethod
+    def for_sprite(cls, item, extra_scale, supersample, profile=RENDER_PROFILE_FINAL):
+        # renders at the sheet cell size times supersample, None keeps the .blend resolution
+        if not supersample:
+            return cls(profile=profile)
+        sprite = SpriteSize(item, extra_scale)
+        return cls(resolution=(sprite.width * supersample, sprite.height * supersample), profile=profile)
+
+    @classmethod
+    def from_dict(cls, settings):
+        resolution = settings.get("resolution")
+        return cls(
+            resolution=tuple(resolution) if resolution else None,
+            profile=settings.get("profile", RENDER_PROFILE_FINAL)
+        )
+
+    def to_dict(self):
+        return {
+            "resolution": list(self.resolution) if self.resolution else None,
+            "profile": self.profile,
+        }
+
+    def get_profile_overrides(self):
+        return {key: value for key, value in RENDER_PROFILES[self.profile].items() if key != "publish"}
+
+    def changes_scene(self):
+        return self.resolution is not None or bool(self.get_profile_overrides())
+
+    def apply(self, scene):
+        if self.resolution:
+            scene.render.resolution_x, scene.render.resolution_y = self.resolution
+            scene.render.resolution_percentage = 100
+            scene.render.pixel_aspect_x = 1
+            scene.render.pixel_aspect_y = 1
+            camera = scene.camera
+            if camera and camera.data.type == 'ORTHO':
+                # ortho_scale spans the width whatever the resolution, so the
+                # framing of the sprite is the same at every size
+                camera.data.sensor_fit = 'HORIZONTAL'
+        self.apply_profile(scene)
+
+    def apply_profile(self, scene):
+        overrides = self.get_profile_overrides()
+        for engine in overrides.get("engines", []):
+            try:
+                scene.render.engine = engine
+                break
+            except TypeError:
+                # not an engine of this Blender version
+                continue
+        if "samples" in overrides:
+            if scene.render.engine == 'CYCLES':
+                scene.cycles.samples = overrides["samples"]
+            elif scene.render.engine != 'BLENDER_WORKBENCH':
+                scene.eevee.taa_render_samples = overrides["samples"]
+        if "use_denoising" in overrides and scene.render.engine == 'CYCLES':
+            scene.cycles.use_denoising = overrides["use_denoising"]
+        if "resolution_percentage" in overrides:
+            scene.render.resolution_percentage = overrides["resolution_percentage"]
+        if "threads" in overrides:
+            if overrides["threads"]:
+                scene.render.threads_mode = 'FIXED'
+                scene.render.threads = overrides["threads"]
+            else:
+                scene.render.threads_mode = 'AUTO'
+
+    def is_publishable(self):
+        return RENDER_PROFILES[self.profile]["publish"]
+
+class Tracer:
+    # Collects timed spans of the pipeline stages. Recording a span is one
+    # perf_counter_ns pair and a list append, so it stays on in production.
+    def __init__(self):
+        self.pid = os.getpid()
+        self.origin_ns = time.perf_counter_ns()
+        self.spans = []
+        # added to every span, e.g. the item and version of the run
+        self.tags = {}
+        # number of the next trace file, for processes writing more than one
+        self.part = 0
+
+    @contextlib.contextmanager
+    def span(self, name, **tags):
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end_ns = time.perf_counter_ns()
+            self.spans.append((name, start_ns, end_ns - start_ns, threading.get_ident(), tags))
+
+    def to_chrome_trace(self):
+        # Chrome/Perfetto "complete" events, timestamps in microseconds
+        events = []
+        for name, start_ns, duration_ns, thread_id, tags in self.spans:
+            events.append({
+                "name": name,
+                "cat": "pipeline",
+                "ph": "X",
+                "ts": (start_ns - self.origin_ns) / 1000,
+                "dur": duration_ns / 1000,
+                "pid": self.pid,
+                "tid": thread_id,
+                "args": {key: str(value) for key, value in {**self.tags, **tags}.items()},
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def summarize(self):
+        summary = {}
+        for name, _start_ns, duration_ns, _thread_id, _tags in self.spans:
+            stage = summary.setdefault(name, {"count": 0, "total_s": 0.0, "max_s": 0.0})
+            stage["count"] += 1
+            stage["total_s"] += duration_ns / 1e9
+            stage["max_s"] = max(stage["max_s"], duration_ns / 1e9)
+        return dict(sorted(summary.items(), key=lambda item: item[1]["total_s"], reverse=True))
+
+    def print_summary(self):
+        print(f'{"stage":<32}{"count":>8}{"total s":>12}{"mean s":>12}{"max s":>12}')
+        for name, stage in self.summarize().items():
+            mean = stage["total_s"] / stage["count"]
+            print(f'{name:<32}{stage["count"]:>8}{stage["total_s"]:>12.3f}{mean:>12.3f}{stage["max_s"]:>12.3f}')
+
+    def write(self, script_name):
+        traces_dir = get_blender_dir().joinpath(f'{TRACES}/')
+        os.makedirs(traces_dir, exist_ok=True)
+        timestamp = time.strftime('%Y%m%d_%H%M%S')
+        part = f'_{self.part}' if self.part else ''
+        trace_path = traces_dir.joinpath(f'{script_name}_{timestamp}_{self.pid}{part}.json')
+        with open(trace_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_chrome_trace(), f)
+        print(f'trace_path: {trace_path}')
+        return trace_path
+
+    def clear(self):
+        # long running processes write their spans in parts, see flush_trace
+        self.spans = []
+        self.part += 1
+
+TRACER = Tracer()
+
+def span(name, **tags):
+    return TRACER.span(name, **tags)
+
+def set_trace_tags(**tags):
+    TRACER.tags.update(tags)
+
+def write_trace(script_name):
+    TRACER.print_summary()
+    return TRACER.write(script_name)
+
+def flush_trace(script_name, min_spans=1):
+    # writes the spans collected so far in their own trace file and drops
+    # them, once there are min_spans of them
+    if len(TRACER.spans) < min_spans:
+        return None
+    trace_path = write_trace(script_name)
+    TRACER.clear()
+    return trace_path
+
 def get_blender_dir():
     current_dir = pathlib.Path(os.getcwd())
     gamedev = current_dir.parent.parent.parent
@@ -73,8 +264,8 @@ def get_blender_dir():
 def get_or_create_renders_dir(item, version):
     blender_dir = get_blender_dir()
     renders_dir = blender_dir.joinpath(f'{RENDERS}/{WORLD_MAP}/{item}/{version}/')
-    if not os.path.exists(renders_dir):
-        os.makedirs(renders_dir, exist_ok=False)
+    # exist_ok: scripts of the same model can start at the same time
+    os.makedirs(renders_dir, exist_ok=True)
     print(f'renders_dir: {renders_dir}')
     return renders_dir
 
@@ -102,13 +293,83 @@ def prepare_frame_filenames(n_frames):
         filenames.append(filename)
     return filenames
 
+def shard_frame_range(n_frames, n_shards):
+    # splits 1..n_frames into at most n_shards contiguous (frame_start, frame_end)
+    n_shards = max(1, min(n_shards, n_frames))
+    shard_size, remainder = divmod(n_frames, n_shards)
+    shards = []
+    frame_start = 1
+    for shard in range(n_shards):
+        frame_end = frame_start + shard_size - 1 + (1 if shard < remainder else 0)
+        shards.append((frame_start, frame_end))
+        frame_start = frame_end + 1
+    return shards
+
+def find_missing_frames(output_dir, n_frames):
+    return [
+        filename for filename in prepare_frame_filenames(n_frames)
+        if not os.path.exists(os.path.join(output_dir, filename))
+    ]
+
+def check_frames_complete(output_dirs, n_frames):
+    incomplete = {}
+    for output_dir in output_dirs:
+        missing = find_missing_frames(output_dir, n_frames)
+        if missing:
+            incomplete[str(output_dir)] = missing
+    for output_dir, missing in incomplete.items():
+        print(f'missing frames in {output_dir}: {", ".join(missing)}')
+    if incomplete:
+        raise RuntimeError(f'{len(incomplete)} output dirs have missing frames')
+
+def apply_render_settings(render_settings):
+    import bpy
+
+    if render_settings:
+        render_settings.apply(bpy.context.scene)
+
+def get_render_metadata_path(output_path):
+    # output dirs of frames have one for all of them, single renders one each
+    if os.path.isdir(output_path):
+        return os.path.join(output_path, RENDER_METADATA)
+    return f'{output_path}.{RENDER_METADATA}'
+
+def write_render_metadata(output_path, render_settings):
+    # records what rendered output_path, for the sheets made from it
+    render_settings = render_settings or RenderSettings()
+    metadata_path = get_render_metadata_path(output_path)
+    temp_path = f'{metadata_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(render_settings.to_dict(), f, ensure_ascii=False, indent=4)
+    os.replace(temp_path, metadata_path)
+
+def read_render_settings(image_path):
+    # settings a frame was rendered with, None for renders older than the metadata
+    for metadata_path in [get_render_metadata_path(image_path), os.path.join(os.path.dirname(image_path), RENDER_METADATA)]:
+        if os.path.exists(metadata_path):
+            with open(metadata_path, 'r', encoding='utf-8') as f:
+                return RenderSettings.from_dict(json.load(f))
+    return None
+
+def get_render_cache_settings(render_settings):
+    # keeps the cache keys of the renders made with the .blend settings unchanged
+    if not (render_settings and render_settings.changes_scene()):
+        return {}
+    return {"render": render_settings.to_dict()}
+
+def should_save_source(render_settings):
+    # never write settings applied by the scripts back into the source .blend
+    return not (render_settings and render_settings.changes_scene())
+
 def set_object_as_active(name):
+    import bpy
+
     object = bpy.context.scene.objects[name]
     bpy.ops.object.select_all(action='DESELECT')
     bpy.context.view_layer.objects.active = object
     object.select_set(True)
 
-def save_smoke_dict_to_path(item, version, target_dir, extension, dict_to_save):
+def get_smoke_target_path(item, version, target_dir, extension):
     current_dir = pathlib.Path(os.getcwd())
     target_dir = current_dir.joinpath(f'{target_dir}/')
     print(f'target_dir: {target_dir}')
@@ -118,6 +379,17 @@ def save_smoke_dict_to_path(item, version, target_dir, extension, dict_to_save):
 
     target_path = os.path.join(target_dir, output_filename)
     print(f'target_path: {target_path}')
+    return target_path
+
+def save_smoke_dict_to_path(item, version, target_dir, extension, dict_to_save):
+    import publish
+
+    target_path = get_smoke_target_path(item, version, target_dir, extension)
+    data = json.dumps(dict_to_save, ensure_ascii=False, indent=4).encode('utf-8')
+    return publish.publish_bytes(data, target_path)
+
+def save_smoke_binary_to_path(item, version, target_dir, extension, data):
+    import publish
 
-    with open(target_path, 'w', encoding='utf-8') as f:
-        json.dump(dict_to_save, f, ensure_ascii=False, indent=4)
+    target_path = get_smoke_target_path(item, version, target_dir, extension)
+    return publish.publish_bytes(data, target_path)
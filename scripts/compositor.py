@@ -0,0 +1,59 @@
+import common
+import numpy as np
+import os
+import png_stream
+from PIL import Image
+
+
+def resize_frame(frame, width, height):
+    factor_x, remainder_x = divmod(frame.width, width)
+    factor_y, remainder_y = divmod(frame.height, height)
+    if factor_x == factor_y and factor_x > 1 and not remainder_x and not remainder_y:
+        # supersampled render: a single box filter pass down to the cell size
+        return frame.reduce(factor_x)
+    return frame.resize((width, height), Image.Resampling.LANCZOS)
+
+def load_frame(image_path, width, height):
+    with common.span('load_frame', image_path=image_path):
+        with Image.open(image_path) as image:
+            frame = image.convert('RGBA')
+        if frame.size != (width, height):
+            frame = resize_frame(frame, width, height)
+        return np.asarray(frame)
+
+def composite_sheet(cells, n_cols, n_rows, width, height):
+    # cells: iterable of (col, row, image_path), row 0 is the top row of the sheet
+    sheet = np.zeros((height * n_rows, width * n_cols, 4), dtype=np.uint8)
+    for col, row, image_path in cells:
+        print(f'image_path: {image_path}')
+        top = row * height
+        left = col * width
+        sheet[top:top + height, left:left + width] = load_frame(image_path, width, height)
+    return sheet
+
+def stream_sheet(cells, n_cols, n_rows, width, height, sheet_file_path):
+    # same sheet as composite_sheet, but only one row of cells is in memory:
+    # each row is blitted into a band and written out before the next one
+    sheet_dir = os.path.dirname(sheet_file_path)
+    if not os.path.exists(sheet_dir):
+        os.makedirs(sheet_dir, exist_ok=False)
+    band = np.zeros((height, width * n_cols, 4), dtype=np.uint8)
+    band_row = 0
+    with png_stream.PngStreamWriter(sheet_file_path, width * n_cols, height * n_rows) as writer:
+        for col, row, image_path in cells:
+            if row != band_row:
+                # cells come row by row, row 0 first
+                writer.write_rows(band)
+                band[:] = 0
+                band_row = row
+            print(f'image_path: {image_path}')
+            left = col * width
+            band[:, left:left + width] = load_frame(image_path, width, height)
+        writer.write_rows(band)
+
+def save_sheet(sheet, sheet_file_path):
+    sheet_dir = os.path.dirname(sheet_file_path)
+    if not os.path.exists(sheet_dir):
+        os.makedirs(sheet_dir, exist_ok=False)
+    with common.span('save_sheet', sheet_file_path=sheet_file_path):
+        Image.fromarray(sheet, 'RGBA').save(sheet_file_path)
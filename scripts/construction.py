@@ -1,7 +1,9 @@
-import bpy
 import common
 import math
 import os
+import pool
+import time
+import worker
 
 
 ATLAS_CONSTRUCTION = 'construction'
@@ -23,6 +25,144 @@ MAX_Z = {
     'train_station': 6.4,
 }
 SPAWN_Z = 4.025
+# the cube is scaled by 4 on z, so the cut is 4 units below its location
+CUBE_HALF_HEIGHT = 4
+CLIP_MATERIAL = 'ConstructionClip'
+CUT_VALUE_NODE = 'ConstructionCut'
+REVEAL_ALPHA_CLIP = 'alpha_clip'
+REVEAL_BOOLEAN = 'boolean'
+REVEAL_BOOLEAN_FAST = 'boolean_fast'
+REVEAL_COMPARISON = 'reveal_comparison'
+REVEALS = [REVEAL_BOOLEAN, REVEAL_BOOLEAN_FAST, REVEAL_ALPHA_CLIP]
+
+def add_construction_cube(item_name, n_frames, subdivide):
+    import bpy
+
+    default_collection = bpy.context.scene.collection.children.get(DEFAULT_COLLECTION)
+
+    bpy.ops.mesh.primitive_cube_add(location=(0,0,SPAWN_Z), scale=(6,6,4))
+    cube = bpy.context.view_layer.objects.active
+    for collection in cube.users_collection:
+        if collection.name in bpy.data.collections.keys():
+            bpy.data.collections[collection.name].objects.unlink(cube)
+    default_collection.objects.link(cube)
+    cube.name = CONSTRUCTION_CUBE
+    cube.hide_render = True
+    cube.lineart.usage = 'EXCLUDE'
+
+    if subdivide:
+        bpy.ops.object.mode_set(mode='EDIT')
+        bpy.ops.mesh.subdivide(number_cuts=21)
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+    cube.keyframe_insert(data_path='location', frame=1)
+    cube.location.z = MAX_Z[item_name]
+    cube.keyframe_insert(data_path='location', frame=n_frames)
+    return cube
+
+def iterate_collection_meshes(collection_names):
+    import bpy
+
+    for collection_name in collection_names:
+        collection = bpy.data.collections[collection_name]
+        for object in collection.all_objects:
+            if object.type == 'MESH':
+                yield object
+
+def setup_boolean_reveal(item_name, n_frames, collection_names, fast):
+    # fast: plain 6 faces cutter and the FAST solver instead of the
+    # subdivided cube with the default EXACT solver
+    cube = add_construction_cube(item_name, n_frames, subdivide=not fast)
+    for object in iterate_collection_meshes(collection_names):
+        modifier = object.modifiers.new(type='BOOLEAN', name='Construction')
+        modifier.object = cube
+        modifier.operation = 'DIFFERENCE'
+        if fast:
+            modifier.solver = 'FAST'
+
+def add_alpha_clip_nodes(material, cube):
+    material.use_nodes = True
+    nodes = material.node_tree.nodes
+    links = material.node_tree.links
+    node_output = next(
+        (node for node in nodes if node.type == 'OUTPUT_MATERIAL' and node.is_active_output),
+        None
+    )
+    if node_output is None or not node_output.inputs['Surface'].links:
+        # nothing to cut, the mesh would show whole from the first frame
+        raise ValueError(f'material {material.name} has no surface linked to its active output')
+
+    surface_socket = node_output.inputs['Surface'].links[0].from_socket
+    node_geometry = nodes.new('ShaderNodeNewGeometry')
+    node_separate = nodes.new('ShaderNodeSeparateXYZ')
+    node_cut = nodes.new('ShaderNodeValue')
+    node_cut.name = CUT_VALUE_NODE
+    node_compare = nodes.new('ShaderNodeMath')
+    node_compare.operation = 'LESS_THAN'
+    node_transparent = nodes.new('ShaderNodeBsdfTransparent')
+    node_mix = nodes.new('ShaderNodeMixShader')
+
+    # the Value node is driven by the cube, so every material shares one cutter
+    driver = node_cut.outputs[0].driver_add('default_value').driver
+    driver.type = 'SCRIPTED'
+    variable = driver.variables.new()
+    variable.name = 'z'
+    variable.type = 'TRANSFORMS'
+    variable.targets[0].id = cube
+    variable.targets[0].transform_type = 'LOC_Z'
+    variable.targets[0].transform_space = 'WORLD_SPACE'
+    driver.expression = f'z - {CUBE_HALF_HEIGHT}'
+
+    links.new(node_geometry.outputs['Position'], node_separate.inputs['Vector'])
+    links.new(node_separate.outputs['Z'], node_compare.inputs[0])
+    links.new(node_cut.outputs['Value'], node_compare.inputs[1])
+    links.new(node_compare.outputs['Value'], node_mix.inputs['Fac'])
+    links.new(node_transparent.outputs['BSDF'], node_mix.inputs[1])
+    links.new(surface_socket, node_mix.inputs[2])
+    links.new(node_mix.outputs['Shader'], node_output.inputs['Surface'])
+
+    if hasattr(material, 'blend_method'):
+        material.blend_method = 'CLIP'
+    if hasattr(material, 'shadow_method'):
+        material.shadow_method = 'CLIP'
+
+def add_clip_material(cube):
+    import bpy
+
+    # use_nodes gives it the default Principled BSDF linked to the output
+    material = bpy.data.materials.new(CLIP_MATERIAL)
+    add_alpha_clip_nodes(material, cube)
+    return material
+
+def setup_alpha_clip_reveal(item_name, n_frames, collection_names):
+    # the cube is only used as the animated cut height, nothing is evaluated
+    # as geometry. Line art still sees the uncut meshes.
+    cube = add_construction_cube(item_name, n_frames, subdivide=False)
+    clipped_materials = {}
+    clip_material = None
+    for object in iterate_collection_meshes(collection_names):
+        if not object.material_slots:
+            # an empty slot of its own: the mesh data may be shared with
+            # objects outside the collections
+            if object.data.users > 1:
+                object.data = object.data.copy()
+            object.data.materials.append(None)
+        for slot in object.material_slots:
+            material = slot.material
+            # object linked, so linked duplicates outside the collections stay whole
+            slot.link = 'OBJECT'
+            if material is None:
+                # meshes without a material get a default one, so they are cut too
+                if clip_material is None:
+                    clip_material = add_clip_material(cube)
+                slot.material = clip_material
+                continue
+            # copies, so materials shared with objects outside the collections stay whole
+            if material.name not in clipped_materials:
+                clipped_material = material.copy()
+                add_alpha_clip_nodes(clipped_material, cube)
+                clipped_materials[material.name] = clipped_material
+            slot.material = clipped_materials[material.name]
 
 def render_animations(
         item_name,
@@ -32,48 +172,152 @@ def render_animations(
         do_render, 
         n_frames,
         collection_names,
+        render_cache=None,
+        reveal=REVEAL_BOOLEAN,
+        frame_start=1,
+        frame_end=None,
+        render_settings=None,
     ):
+    # frame_start and frame_end render only part of the animation, the cube
+    # still rises over the whole n_frames
+    frame_end = frame_end or n_frames
+    is_whole_animation = frame_start == 1 and frame_end == n_frames
     print(f'output_dir: {output_dir}')
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=False)
 
     if do_render:
-        bpy.ops.wm.open_mainfile(filepath=model_path)
+        import bpy
+
+        unit = output_dir.name
+        if render_cache:
+            key = get_cache_key(render_cache, item_name, model_path, degree, n_frames, collection_names, reveal, render_settings)
+            if is_cached(render_cache, unit, key, output_dir, n_frames):
+                print(f'cached: {unit}')
+                return output_dir
+        with common.span('open_mainfile', file=model_path):
+            bpy.ops.wm.open_mainfile(filepath=model_path)
+        common.apply_render_settings(render_settings)
         bpy.context.scene.render.filepath = f'{output_dir.as_posix()}/'
-        bpy.context.scene.frame_start = 1
-        bpy.context.scene.frame_end = n_frames
+        bpy.context.scene.frame_start = frame_start
+        bpy.context.scene.frame_end = frame_end
 
         common.set_object_as_active(common.EMPTY_ORIGIN)
         bpy.context.active_object.rotation_euler[2] = math.radians(degree)
-        default_collection = bpy.context.scene.collection.children.get(DEFAULT_COLLECTION)
-
-        bpy.ops.mesh.primitive_cube_add(location=(0,0,SPAWN_Z), scale=(6,6,4))
-        cube = bpy.context.view_layer.objects.active
-        for collection in cube.users_collection:
-            if collection.name in bpy.data.collections.keys():
-                bpy.data.collections[collection.name].objects.unlink(cube)
-        default_collection.objects.link(cube)
-        cube.name = CONSTRUCTION_CUBE
-        cube.hide_render = True
-        cube.lineart.usage = 'EXCLUDE'
+        with common.span('reveal_setup', item=item_name, degree=degree, reveal=reveal):
+            if reveal == REVEAL_ALPHA_CLIP:
+                setup_alpha_clip_reveal(item_name, n_frames, collection_names)
+            else:
+                setup_boolean_reveal(item_name, n_frames, collection_names, fast=reveal == REVEAL_BOOLEAN_FAST)
 
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.subdivide(number_cuts=21)
-        bpy.ops.object.mode_set(mode='OBJECT')
+        with common.span('render', item=item_name, degree=degree, frames=f'{frame_start}-{frame_end}'):
+            bpy.ops.render.render(animation=True)
+        common.write_render_metadata(output_dir, render_settings)
+        if not is_whole_animation:
+            # other shards render into the same output_dir, and the cache
+            # is only stored for whole animations
+            return output_dir
+        temp_filepath = os.path.join(output_dir, f'temp.blend')
+        with common.span('save_as_mainfile', file=temp_filepath):
+            bpy.ops.wm.save_as_mainfile(filepath=temp_filepath)
+        if render_cache:
+            render_cache.store(unit, key)
+    return output_dir
 
-        cube.keyframe_insert(data_path='location', frame=1)
-        cube.location.z = MAX_Z[item_name]
-        cube.keyframe_insert(data_path='location', frame=n_frames)
+def get_cache_key(render_cache, item_name, model_path, degree, n_frames, collection_names, reveal, render_settings=None):
+    return render_cache.make_key(
+        model_path,
+        n_frames=n_frames,
+        degree=degree,
+        max_z=MAX_Z[item_name],
+        spawn_z=SPAWN_Z,
+        collection_names=collection_names,
+        reveal=reveal,
+        **common.get_render_cache_settings(render_settings),
+    )
 
-        for collection_name in collection_names:
-            collection = bpy.data.collections[collection_name]
-            for object in collection.all_objects:
-                if object.type == 'MESH':
-                    modifier = object.modifiers.new(type='BOOLEAN', name='Construction')
-                    modifier.object = cube
-                    modifier.operation = 'DIFFERENCE'
+def is_cached(render_cache, unit, key, output_dir, n_frames):
+    output_paths = [output_dir.joinpath(filename) for filename in common.prepare_frame_filenames(n_frames)]
+    return render_cache.is_fresh(unit, key, output_paths)
 
-        bpy.ops.render.render(animation=True)
-        temp_filepath = os.path.join(output_dir, f'temp.blend')
-        bpy.ops.wm.save_as_mainfile(filepath=temp_filepath)
-    return output_dir
\ No newline at end of file
+def render_animations_in_workers(
+        item_name,
+        units,
+        n_frames,
+        collection_names,
+        n_workers,
+        n_shards,
+        render_cache=None,
+        reveal=REVEAL_BOOLEAN,
+        render_settings=None,
+    ):
+    # units: (model_path, output_dir, degree) for each degree or variety.
+    # Every unit is split into n_shards frame ranges, each rendered by its own
+    # worker into the same output_dir.
+    jobs = []
+    keys = {}
+    for model_path, output_dir, degree in units:
+        os.makedirs(output_dir, exist_ok=True)
+        unit = output_dir.name
+        if render_cache:
+            keys[unit] = get_cache_key(render_cache, item_name, model_path, degree, n_frames, collection_names, reveal, render_settings)
+            if is_cached(render_cache, unit, keys[unit], output_dir, n_frames):
+                print(f'cached: {unit}')
+                continue
+        for frame_start, frame_end in common.shard_frame_range(n_frames, n_shards):
+            jobs.append({
+                'kind': worker.KIND_RENDER_CONSTRUCTION,
+                'name': f'{unit}:{frame_start}-{frame_end}',
+                'unit': unit,
+                'item': item_name,
+                'model_path': model_path,
+                'output_dir': str(output_dir),
+                'degree': degree,
+                'n_frames': n_frames,
+                'collection_names': collection_names,
+                'reveal': reveal,
+                'frame_start': frame_start,
+                'frame_end': frame_end,
+                'render_settings': render_settings.to_dict() if render_settings else None,
+            })
+    results = pool.run_worker_jobs(jobs, n_workers)
+    pool.report_failures(results)
+
+    output_dirs = [output_dir for _model_path, output_dir, _degree in units]
+    common.check_frames_complete(output_dirs, n_frames)
+    if render_cache:
+        # the cache file is only written here, never by the workers
+        for unit in sorted(set(job['unit'] for job in jobs)):
+            render_cache.store(unit, keys[unit])
+    return output_dirs
+
+def compare_reveals(
+        item_name,
+        model_path,
+        comparison_dir,
+        degree,
+        n_frames,
+        collection_names,
+    ):
+    timings = {}
+    for reveal in REVEALS:
+        output_dir = comparison_dir.joinpath(reveal)
+        start = time.perf_counter()
+        render_animations(
+            item_name,
+            model_path,
+            output_dir,
+            degree,
+            True,
+            n_frames,
+            collection_names,
+            reveal=reveal,
+        )
+        timings[reveal] = time.perf_counter() - start
+
+    print(f'reveal comparison for {item_name}, degree {degree}, {n_frames} frames:')
+    for reveal, seconds in timings.items():
+        speedup = timings[REVEAL_BOOLEAN] / seconds
+        print(f'{reveal:>14}: {seconds:8.2f}s  x{speedup:.2f} vs {REVEAL_BOOLEAN}')
+    print(f'{REVEAL_ALPHA_CLIP} does not cut the line art: its outlines show the whole building from the first frame')
+    return timings
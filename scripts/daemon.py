@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+# blender -P does not put the script directory on sys.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+import worker
+
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "blender_scripts_worker.sock")
+KIND_PING = "ping"
+KIND_SHUTDOWN = "shutdown"
+# spans kept before the trace is written in the middle of a connection
+TRACE_FLUSH_SPANS = 10000
+
+# Protocol: one JSON job per line, answered by one JSON line per job:
+# {"ok": true, "result": ..., "seconds": ...} or {"ok": false, "error": "..."}.
+# Jobs are the worker.JOBS kinds, e.g.
+# {"kind": "render_direction", "file": "...", "root_output_dir": "...",
+#  "n_frames": 24, "frame_start": 1, "frame_end": 12}
+# {"kind": "export_static_smoke", "item": "steel_works", "filename": "..."}
+
+def clear_scene_state():
+    import bpy
+
+    # an empty scene, the preferences (the compute device, the add-ons)
+    # stay as the warm session loaded them
+    bpy.ops.wm.read_homefile(use_empty=True)
+
+def parse_job(line):
+    # returns (job, None), or (None, error) for lines that are not a job
+    try:
+        job = json.loads(line)
+    except ValueError as error:
+        return None, f'malformed JSON: {error}'
+    if not isinstance(job, dict) or 'kind' not in job:
+        return None, 'a job is a JSON object with a "kind"'
+    return job, None
+
+def handle_job(job):
+    if job['kind'] == KIND_PING:
+        return {"ok": True, "result": None, "seconds": 0.0}
+
+    start = time.perf_counter()
+    try:
+        with common.span(job['kind'], job=job.get('name', '')):
+            result = worker.run_job(job)
+        response = {"ok": True, "result": result}
+    except Exception:
+        response = {"ok": False, "error": traceback.format_exc()}
+    try:
+        clear_scene_state()
+    except Exception:
+        response = {"ok": False, "error": traceback.format_exc()}
+    response["seconds"] = time.perf_counter() - start
+    return response
+
+def serve_connection(connection):
+    # returns False when a shutdown job was received
+    with connection, connection.makefile('rwb') as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            job, error = parse_job(line)
+            if error:
+                response = {"ok": False, "error": error}
+            elif job['kind'] == KIND_SHUTDOWN:
+                stream.write(b'{"ok": true, "result": null}\n')
+                stream.flush()
+                return False
+            else:
+                response = handle_job(job)
+            stream.write(json.dumps(response).encode('utf-8') + b'\n')
+            stream.flush()
+            common.flush_trace('daemon', TRACE_FLUSH_SPANS)
+    return True
+
+def is_served(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        try:
+            client.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+def serve(socket_path):
+    if os.path.exists(socket_path):
+        if is_served(socket_path):
+            raise RuntimeError(f'a daemon is already listening on {socket_path}')
+        # left by a daemon that did not shut down
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    print(f'listening on {socket_path}')
+    try:
+        # bpy is not thread safe, jobs are run one at a time
+        while True:
+            connection, _address = server.accept()
+            try:
+                keep_serving = serve_connection(connection)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client left before its answer, the next one is still served
+                print('client disconnected')
+                keep_serving = True
+            # written per connection, so a long session never holds all its spans
+            common.flush_trace('daemon')
+            if not keep_serving:
+                break
+    finally:
+        server.close()
+        os.remove(socket_path)
+        common.flush_trace('daemon')
+
+def submit(jobs, socket_path=DEFAULT_SOCKET):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    responses = []
+    with client, client.makefile('rwb') as stream:
+        for job in jobs:
+            stream.write(json.dumps(job).encode('utf-8') + b'\n')
+            stream.flush()
+            responses.append(json.loads(stream.readline()))
+    return responses
+
+def parse_arguments():
+    # everything after `--` when run as `blender -b -P daemon.py -- ...`
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, choices=['serve', 'submit'])
+    parser.add_argument('jobs', type=str, nargs='*', help='JSON jobs to submit')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_arguments()
+    if args.command == 'serve':
+        serve(args.socket)
+    else:
+        for response in submit([json.loads(job) for job in args.jobs], args.socket):
+            print(json.dumps(response))
+
+
+if __name__ == "__main__":
+    main()
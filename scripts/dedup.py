@@ -0,0 +1,120 @@
+import compositor
+import hashlib
+import json
+import math
+import numpy as np
+import os
+
+
+INDEX_VERSION = 1
+
+class UniqueFrame:
+    def __init__(self, index, pixels, digest):
+        self.index = index
+        self.pixels = pixels
+        self.digest = digest
+        # (col, row) of every logical cell showing this frame
+        self.cells = []
+
+def normalize_pixels(pixels):
+    # the colour of fully transparent pixels is never seen, so it must not
+    # make two frames different
+    pixels = pixels.copy()
+    pixels[pixels[:, :, 3] == 0] = 0
+    return pixels
+
+def hash_pixels(pixels):
+    return hashlib.sha256(np.ascontiguousarray(pixels).tobytes()).hexdigest()
+
+def is_within_tolerance(pixels, other_pixels, tolerance):
+    difference = np.abs(pixels.astype(np.int16) - other_pixels.astype(np.int16))
+    return int(difference.max()) <= tolerance
+
+def find_unique_frames(cells, width, height, tolerance=0):
+    # cells: iterable of (col, row, image_path). A frame is a duplicate of an
+    # earlier one if they hash the same, or, with a tolerance, if no channel
+    # of any pixel differs by more than tolerance (0-255)
+    unique_frames = []
+    by_digest = {}
+    for col, row, image_path in cells:
+        print(f'image_path: {image_path}')
+        pixels = normalize_pixels(compositor.load_frame(image_path, width, height))
+        digest = hash_pixels(pixels)
+        unique_frame = by_digest.get(digest)
+        if unique_frame is None and tolerance > 0:
+            unique_frame = next(
+                (other for other in unique_frames if is_within_tolerance(pixels, other.pixels, tolerance)),
+                None
+            )
+        if unique_frame is None:
+            unique_frame = UniqueFrame(len(unique_frames), pixels, digest)
+            unique_frames.append(unique_frame)
+            by_digest[digest] = unique_frame
+        unique_frame.cells.append((col, row))
+    return unique_frames
+
+def get_physical_grid(n_unique, n_cols):
+    # keeps the logical number of columns while it fits, so sheets without
+    # duplicates come out the same as the grid layout
+    physical_cols = max(1, min(n_cols, n_unique))
+    physical_rows = max(1, math.ceil(n_unique / physical_cols))
+    return physical_cols, physical_rows
+
+def compose_sheet(unique_frames, physical_cols, physical_rows, width, height):
+    sheet = np.zeros((height * physical_rows, width * physical_cols, 4), dtype=np.uint8)
+    for unique_frame in unique_frames:
+        row, col = divmod(unique_frame.index, physical_cols)
+        sheet[row * height:(row + 1) * height, col * width:(col + 1) * width] = unique_frame.pixels
+    return sheet
+
+def build_index(unique_frames, n_cols, n_rows, physical_cols, physical_rows, width, height, is_animation, sheet_filename):
+    cells = [[None] * n_cols for _ in range(n_rows)]
+    for unique_frame in unique_frames:
+        physical_row, physical_col = divmod(unique_frame.index, physical_cols)
+        for col, row in unique_frame.cells:
+            cells[row][col] = [physical_col, physical_row]
+    return {
+        "version": INDEX_VERSION,
+        "file": sheet_filename,
+        "cell_size": [width, height],
+        "is_animation": is_animation,
+        "logical_grid": [n_cols, n_rows],
+        "physical_grid": [physical_cols, physical_rows],
+        # cells[row][col]: [col, row] of the physical cell drawn for that logical cell
+        "cells": cells,
+    }
+
+def get_index_path(sheet_file_path):
+    return f'{os.path.splitext(sheet_file_path)[0]}_frames.json'
+
+def make_dedup_sheet(cells, n_cols, n_rows, width, height, is_animation, sheet_file_path, tolerance=0):
+    # writes the unique frames as a grid sheet at sheet_file_path and the
+    # logical to physical cell map next to it as <name>_frames.json
+    unique_frames = find_unique_frames(cells, width, height, tolerance)
+    n_cells = sum(len(unique_frame.cells) for unique_frame in unique_frames)
+    print(f'unique frames: {len(unique_frames)} of {n_cells}')
+    physical_cols, physical_rows = get_physical_grid(len(unique_frames), n_cols)
+    compositor.save_sheet(
+        compose_sheet(unique_frames, physical_cols, physical_rows, width, height),
+        sheet_file_path
+    )
+
+    index = build_index(
+        unique_frames,
+        n_cols,
+        n_rows,
+        physical_cols,
+        physical_rows,
+        width,
+        height,
+        is_animation,
+        os.path.basename(sheet_file_path),
+    )
+    index_path = get_index_path(sheet_file_path)
+    print(f'index_path: {index_path}')
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+    return [sheet_file_path, index_path]
+
+def list_dedup_files(sheet_file_path):
+    return [sheet_file_path, get_index_path(sheet_file_path)]
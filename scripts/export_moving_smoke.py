@@ -1,9 +1,13 @@
 import argparse
-import bpy
-import bpy_extras
 import common
-import mathutils
+import numpy as np
 import os
+import pool
+import projection
+import publish
+import smoke_binary
+import smoke_curves
+import worker
 
 
 CAMERA = "Camera.001"
@@ -23,6 +27,8 @@ DIRECTIONS_MAP = {
     "TR-TL": "TopRightTopLeft",
 }
 SMOKE_DATA_ASSETS = "assets/smoke_data/moving"
+SMOKE_BINARY_EXTENSION = "moving_smoke.bin"
+SMOKE_CURVES_EXTENSION = "moving_smoke_curves.json"
 SMOKE_EMITTER = "SmokeEmitter"
 SMOKE_OUTPUT_EXTENSION = "moving_smoke.json"
 
@@ -31,6 +37,12 @@ def parse_arguments():
     parser.add_argument('item', type=str, help='name of the folder in world_map')
     parser.add_argument('version', type=str, help='name of the file where the model is')
     parser.add_argument('--n_frames', type=int, default=24)
+    parser.add_argument('--vectorized', action='store_true', help='project every frame in one numpy batch')
+    parser.add_argument('--binary', action='store_true', help='also write the packed float32 binary format')
+    parser.add_argument('--workers', type=int, default=1, help='number of background Blender processes exporting directions')
+    parser.add_argument('--curves', action='store_true', help='also write every track fitted as a curve, or as samples when none is within tolerance')
+    parser.add_argument('--emitter_tolerance', type=float, default=0.25, help='largest distance, in sprite pixels, between an emitter sample and its curve')
+    parser.add_argument('--direction_tolerance', type=float, default=0.001, help='largest distance, in camera frame units, between a direction sample and its curve')
     return parser.parse_args()
 
 def find_target_files(item, version):
@@ -41,59 +53,149 @@ def find_target_files(item, version):
         for name in files:
             if name[-6:] == ".blend":
                 target_files.append(os.path.join(root, name))
-    return target_files
+    # sorted by DIRECTIONS_MAP key, not by os.walk order, so the output is
+    # the same whether it is exported serially or by workers
+    directions_order = list(DIRECTIONS_MAP)
+    return sorted(target_files, key=lambda file: directions_order.index(file.split(".")[0][-5:]))
 
 def get_camera_view_coords(scene, active_camera, name):
+    import bpy
+    import bpy_extras
+    import mathutils
+
     object = bpy.context.scene.objects[name]
     location = object.matrix_world.to_translation()
     full_coords = bpy_extras.object_utils.world_to_camera_view(scene, active_camera, location)
     coords = mathutils.Vector((full_coords.x, full_coords.y))
     return coords
 
-def extract_dict_from_target_files(target_files, n_frames, item):
+def extract_frames_data(n_frames, sprite):
+    import bpy
+    import mathutils
+
+    common.set_object_as_active(CAMERA)
+
+    frames_data = []
+
+    for frame in range(n_frames):
+        blender_frame_id = frame + 1
+        print(f'blender_frame_id: {blender_frame_id}')
+        bpy.context.scene.frame_set(blender_frame_id)
+
+        smoke_emitter_coords = get_camera_view_coords(bpy.context.scene, bpy.context.object, SMOKE_EMITTER)
+        direction_ref_coords = get_camera_view_coords(bpy.context.scene, bpy.context.object, DIRECTION_REFERENCE)
+
+        emitter_coords_on_sprite = smoke_emitter_coords * mathutils.Vector((sprite.width, sprite.height))
+        smoke_direction = direction_ref_coords - smoke_emitter_coords
+        smoke_data_this_frame = {
+            "frame": frame,
+            "emitter_coords": list(emitter_coords_on_sprite),
+            "smoke_direction": list(smoke_direction)
+        }
+        frames_data.append(smoke_data_this_frame)
+    return frames_data
+
+def sample_frames(scene, camera, n_frames):
+    # frame_set is still needed to evaluate the animation, but each frame only
+    # copies matrices out, the projection happens afterwards in one batch
+    emitter = scene.objects[SMOKE_EMITTER]
+    direction_reference = scene.objects[DIRECTION_REFERENCE]
+    emitter_locations = np.empty((n_frames, 3))
+    reference_locations = np.empty((n_frames, 3))
+    camera_matrices = np.empty((n_frames, 4, 4))
+    for frame in range(n_frames):
+        scene.frame_set(frame + 1)
+        emitter_locations[frame] = emitter.matrix_world.to_translation()
+        reference_locations[frame] = direction_reference.matrix_world.to_translation()
+        camera_matrices[frame] = camera.matrix_world
+    return emitter_locations, reference_locations, camera_matrices
+
+def extract_frames_data_vectorized(n_frames, sprite):
+    import bpy
+
+    scene = bpy.context.scene
+    camera = scene.objects[CAMERA]
+    emitter_locations, reference_locations, camera_matrices = sample_frames(scene, camera, n_frames)
+    if np.all(camera_matrices == camera_matrices[0]):
+        # static camera, invert its matrix only once
+        camera_matrices = camera_matrices[0]
+    view_frame = projection.get_view_frame(scene, camera)
+    is_ortho = projection.get_is_ortho(camera)
+
+    emitter_coords = projection.world_to_camera_view(camera_matrices, view_frame, is_ortho, emitter_locations)[:, :2]
+    reference_coords = projection.world_to_camera_view(camera_matrices, view_frame, is_ortho, reference_locations)[:, :2]
+    emitter_coords_on_sprite = emitter_coords * np.array([sprite.width, sprite.height])
+    smoke_directions = reference_coords - emitter_coords
+
+    return [
+        {
+            "frame": frame,
+            "emitter_coords": emitter_coords_on_sprite[frame].tolist(),
+            "smoke_direction": smoke_directions[frame].tolist(),
+        }
+        for frame in range(n_frames)
+    ]
+
+def extract_direction_frame(file, n_frames, sprite, vectorized=False):
+    import bpy
+
+    travel_directions = file.split(".")[0][-5:]
+    print(f'travel_directions: {travel_directions}')
+
+    with common.span('open_mainfile', file=file):
+        bpy.ops.wm.open_mainfile(filepath=file)
+    with common.span('extract_smoke', direction=travel_directions, frames=f'1-{n_frames}'):
+        if vectorized:
+            frames_data = extract_frames_data_vectorized(n_frames, sprite)
+        else:
+            frames_data = extract_frames_data(n_frames, sprite)
+
+    direction_frame = {
+        "pair": {
+            "diagonal_pair": DIRECTIONS_MAP[travel_directions]
+        },
+        "frames": frames_data
+    }
+    return direction_frame
+
+def extract_dict_from_target_files(target_files, n_frames, item, vectorized=False):
     output_dict = { "direction_frames": [] }
     sprite = common.SpriteSize(item)
 
     for file in target_files:
-        travel_directions = file.split(".")[0][-5:]
-        print(f'travel_directions: {travel_directions}')
-
-        bpy.ops.wm.open_mainfile(filepath=file)
-        common.set_object_as_active(CAMERA)
-
-        frames_data = []
-
-        for frame in range(n_frames):
-            blender_frame_id = frame + 1
-            print(f'blender_frame_id: {blender_frame_id}')
-            bpy.context.scene.frame_set(blender_frame_id)
-
-            smoke_emitter_coords = get_camera_view_coords(bpy.context.scene, bpy.context.object, SMOKE_EMITTER)
-            direction_ref_coords = get_camera_view_coords(bpy.context.scene, bpy.context.object, DIRECTION_REFERENCE)
-
-            emitter_coords_on_sprite = smoke_emitter_coords * mathutils.Vector((sprite.width, sprite.height))
-            smoke_direction = direction_ref_coords - smoke_emitter_coords
-            smoke_data_this_frame = {
-                "frame": frame,
-                "emitter_coords": list(emitter_coords_on_sprite),
-                "smoke_direction": list(smoke_direction)
-            }
-            frames_data.append(smoke_data_this_frame)
-
-        direction_frame = {
-            "pair": {
-                "diagonal_pair": DIRECTIONS_MAP[travel_directions]
-            },
-            "frames": frames_data
-        }
+        direction_frame = extract_direction_frame(file, n_frames, sprite, vectorized)
         output_dict["direction_frames"].append(direction_frame)
     return output_dict
 
+def extract_dict_in_workers(target_files, n_frames, item, vectorized, n_workers):
+    jobs = []
+    for file in target_files:
+        jobs.append({
+            'kind': worker.KIND_EXPORT_MOVING_SMOKE,
+            'name': file.split(".")[0][-5:],
+            'file': file,
+            'n_frames': n_frames,
+            'item': item,
+            'vectorized': vectorized,
+        })
+    results = pool.run_worker_jobs(jobs, n_workers)
+    pool.report_failures(results)
+    return { "direction_frames": [result.result for result in results] }
 
 def main():
     args = parse_arguments()
+    common.set_trace_tags(item=args.item, version=args.version)
     target_files = find_target_files(args.item, args.version)
-    output_dict = extract_dict_from_target_files(target_files, args.n_frames, args.item)
+    if args.workers > 1:
+        output_dict = extract_dict_in_workers(
+            target_files,
+            args.n_frames,
+            args.item,
+            args.vectorized,
+            args.workers
+        )
+    else:
+        output_dict = extract_dict_from_target_files(target_files, args.n_frames, args.item, args.vectorized)
     common.save_smoke_dict_to_path(
         args.item,
         args.version,
@@ -101,6 +203,31 @@ def main():
         SMOKE_OUTPUT_EXTENSION,
         output_dict
     )
+    if args.binary:
+        direction_names = list(DIRECTIONS_MAP.values())
+        data = smoke_binary.encode_moving_smoke(args.item, args.version, output_dict, direction_names)
+        smoke_binary.verify_round_trip(data, output_dict, direction_names)
+        common.save_smoke_binary_to_path(
+            args.item,
+            args.version,
+            SMOKE_DATA_ASSETS,
+            SMOKE_BINARY_EXTENSION,
+            data
+        )
+    if args.curves:
+        tolerances = {"emitter_coords": args.emitter_tolerance, "smoke_direction": args.direction_tolerance}
+        with common.span('fit_curves', n_frames=args.n_frames):
+            curves_dict = smoke_curves.fit_smoke_dict(output_dict, tolerances)
+        smoke_curves.print_report(curves_dict, smoke_curves.verify_curves(curves_dict, output_dict))
+        common.save_smoke_dict_to_path(
+            args.item,
+            args.version,
+            SMOKE_DATA_ASSETS,
+            SMOKE_CURVES_EXTENSION,
+            curves_dict
+        )
+    publish.print_report()
+    common.write_trace('export_moving_smoke')
 
 
 if __name__ == "__main__":
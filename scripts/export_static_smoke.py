@@ -1,13 +1,15 @@
 import argparse
-import bpy
-import bpy_extras
 import common
 import math
-import mathutils
+import numpy as np
 import os
+import projection
+import publish
+import smoke_binary
 
 
 CAMERA = "Camera"
+SMOKE_BINARY_EXTENSION = "static_smoke.bin"
 SMOKE_DATA_ASSETS = "assets/smoke_data/static"
 SMOKE_EMITTERS = "SmokeEmitters"
 SMOKE_OUTPUT_EXTENSION = "static_smoke.json"
@@ -16,19 +18,50 @@ def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('item', type=str, help='name of the folder in world_map')
     parser.add_argument('filename', type=str, help='name of the file where the model is')
-    return parser.parse_args()
+    parser.add_argument('--binary', action='store_true', help='also write the packed float32 binary format')
+    parser.add_argument('--analytic', action='store_true', help='rotate the emitters with matrices instead of the scene, for any list of degrees')
+    parser.add_argument('--degrees', type=float, nargs='+', default=None, help=f'yaw angles of Origin, {common.DEGREES} if empty, needs --analytic')
+    parser.add_argument('--rotations', type=int, default=None, help='as many evenly spaced yaw angles, instead of --degrees')
+    args = parser.parse_args()
+    if args.rotations is not None and args.rotations < 1:
+        parser.error('--rotations needs at least 1 rotation')
+    if args.rotations:
+        args.degrees = [360 * rotation / args.rotations for rotation in range(args.rotations)]
+    if args.degrees is None:
+        args.degrees = common.DEGREES
+    elif not args.analytic:
+        parser.error('--degrees and --rotations need --analytic')
+    if args.binary:
+        # checked before anything is exported, the JSON is published before the binary is packed
+        if any(degree != int(degree) for degree in args.degrees):
+            parser.error('the binary format only stores whole degrees')
+        if len(args.degrees) > smoke_binary.MAX_STATIC_DEGREES:
+            parser.error(f'the binary format stores at most {smoke_binary.MAX_STATIC_DEGREES} degrees')
+        if any(not 0 <= degree <= smoke_binary.MAX_DEGREE for degree in args.degrees):
+            parser.error(f'the binary format only stores degrees from 0 to {smoke_binary.MAX_DEGREE}')
+    return args
+
+def get_degree_key(degree):
+    return f'degree_{degree:g}'
 
 def get_camera_view_coords(scene, active_camera, emitter):
+    import bpy_extras
+    import mathutils
+
     location = emitter.matrix_world.to_translation()
     full_coords = bpy_extras.object_utils.world_to_camera_view(scene, active_camera, location)
     coords = mathutils.Vector((full_coords.x, full_coords.y))
     return coords
 
 def extract_dict_from_target_files(file_path, item):
+    import bpy
+    import mathutils
+
     output_dict = { "".join(["degree_", str(degree)]): [] for degree in common.DEGREES }
     sprite = common.SpriteSize(item)
 
-    bpy.ops.wm.open_mainfile(filepath=file_path)
+    with common.span('open_mainfile', file=file_path):
+        bpy.ops.wm.open_mainfile(filepath=file_path)
     for degree in common.DEGREES:
         common.set_object_as_active(common.EMPTY_ORIGIN)
         bpy.context.active_object.rotation_euler[2] = math.radians(degree)
@@ -45,10 +78,75 @@ def extract_dict_from_target_files(file_path, item):
             bpy.context.active_object.rotation_euler[2] = math.radians(0)
     return output_dict
 
+def descends_from(object, ancestor):
+    parent = object.parent
+    while parent is not None:
+        if parent == ancestor:
+            return True
+        parent = parent.parent
+    return False
+
+def get_origin_transforms(origin, degrees):
+    # world space transforms moving whatever is under Origin from its current
+    # yaw to each of degrees, the same as setting rotation_euler[2] on it
+    import mathutils
+
+    # matrix_world = outer @ matrix_basis, outer holds the parent if any
+    outer = np.array(origin.matrix_world @ origin.matrix_basis.inverted())
+    euler = origin.rotation_euler.copy()
+    transforms = []
+    for degree in degrees:
+        euler.z = math.radians(degree)
+        basis = mathutils.Matrix.LocRotScale(origin.location, euler, origin.scale)
+        transforms.append(outer @ np.array(basis))
+    return np.array(transforms) @ np.linalg.inv(np.array(origin.matrix_world))
+
+def extract_dict_analytically(file_path, item, degrees):
+    # reads the scene once, then projects every emitter for every degree in
+    # one batch: no depsgraph update per degree, whatever their number
+    import bpy
+
+    sprite = common.SpriteSize(item)
+    with common.span('open_mainfile', file=file_path):
+        bpy.ops.wm.open_mainfile(filepath=file_path)
+    scene = bpy.context.scene
+    origin = scene.objects[common.EMPTY_ORIGIN]
+    camera = scene.objects[CAMERA]
+    emitters = list(bpy.data.collections.get(SMOKE_EMITTERS).objects)
+
+    transforms = get_origin_transforms(origin, degrees)
+    n_degrees, n_emitters = len(degrees), len(emitters)
+    identity = np.broadcast_to(np.eye(4), transforms.shape)
+    emitter_locations = np.empty((n_degrees, n_emitters, 3))
+    for index, emitter in enumerate(emitters):
+        emitter_transforms = transforms if descends_from(emitter, origin) else identity
+        emitter_locations[:, index] = projection.transform_points(
+            emitter_transforms,
+            np.array(emitter.matrix_world.to_translation())
+        )
+    camera_transforms = transforms if descends_from(camera, origin) else identity
+    camera_matrices = camera_transforms @ np.array(camera.matrix_world)
+
+    coords = projection.world_to_camera_view(
+        np.repeat(camera_matrices, n_emitters, axis=0),
+        projection.get_view_frame(scene, camera),
+        projection.get_is_ortho(camera),
+        emitter_locations.reshape(-1, 3),
+    )[:, :2] * [sprite.width, sprite.height]
+    coords = coords.reshape(n_degrees, n_emitters, 2)
+    return {
+        get_degree_key(degree): [list(map(float, emitter_coords)) for emitter_coords in coords[index]]
+        for index, degree in enumerate(degrees)
+    }
+
 def main():
     args = parse_arguments()
+    common.set_trace_tags(item=args.item, version=args.filename)
     model_path = common.get_model_path(args.item, args.filename)
-    output_dict = extract_dict_from_target_files(model_path, args.item)
+    if args.analytic:
+        output_dict = extract_dict_analytically(model_path, args.item, args.degrees)
+    else:
+        output_dict = extract_dict_from_target_files(model_path, args.item)
     common.save_smoke_dict_to_path(
         args.item,
         args.filename,
@@ -56,6 +154,18 @@ def main():
         SMOKE_OUTPUT_EXTENSION,
         output_dict
     )
+    if args.binary:
+        data = smoke_binary.encode_static_smoke(args.item, args.filename, output_dict)
+        smoke_binary.verify_round_trip(data, output_dict)
+        common.save_smoke_binary_to_path(
+            args.item,
+            args.filename,
+            SMOKE_DATA_ASSETS,
+            SMOKE_BINARY_EXTENSION,
+            data
+        )
+    publish.print_report()
+    common.write_trace('export_static_smoke')
 
 
 if __name__ == "__main__":
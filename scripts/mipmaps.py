@@ -0,0 +1,112 @@
+import compositor
+import numpy as np
+import os
+from PIL import Image
+
+
+# Every resize works on premultiplied alpha, so the colour of transparent
+# pixels never bleeds into the visible ones, and on each cell on its own,
+# so no filter reads the pixels of the neighbouring frames.
+
+def premultiply(pixels):
+    premultiplied = pixels.astype(np.float32) / 255
+    premultiplied[..., :3] *= premultiplied[..., 3:4]
+    return premultiplied
+
+def unpremultiply(premultiplied):
+    alpha = premultiplied[..., 3:4]
+    colors = np.divide(premultiplied[..., :3], alpha, out=np.zeros_like(premultiplied[..., :3]), where=alpha > 0)
+    pixels = np.concatenate([colors, alpha], axis=-1)
+    return np.rint(np.clip(pixels, 0, 1) * 255).astype(np.uint8)
+
+def box_downsample(premultiplied, cell_width, cell_height, factor_x, factor_y):
+    # a box never crosses a cell boundary when the factors divide the cell size
+    height, width = premultiplied.shape[:2]
+    n_rows, n_cols = height // cell_height, width // cell_width
+    new_cell_width, new_cell_height = cell_width // factor_x, cell_height // factor_y
+    boxes = premultiplied.reshape(n_rows, new_cell_height, factor_y, n_cols, new_cell_width, factor_x, 4)
+    return boxes.mean(axis=(2, 5)).reshape(n_rows * new_cell_height, n_cols * new_cell_width, 4)
+
+def filter_downsample(premultiplied, cell_width, cell_height, new_cell_width, new_cell_height):
+    height, width = premultiplied.shape[:2]
+    n_rows, n_cols = height // cell_height, width // cell_width
+    resized = np.zeros((n_rows * new_cell_height, n_cols * new_cell_width, 4), dtype=np.float32)
+    for row in range(n_rows):
+        for col in range(n_cols):
+            cell = premultiplied[row * cell_height:(row + 1) * cell_height, col * cell_width:(col + 1) * cell_width]
+            for channel in range(4):
+                channel_image = Image.fromarray(np.ascontiguousarray(cell[:, :, channel]), 'F')
+                channel_image = channel_image.resize((new_cell_width, new_cell_height), Image.Resampling.LANCZOS)
+                resized[
+                    row * new_cell_height:(row + 1) * new_cell_height,
+                    col * new_cell_width:(col + 1) * new_cell_width,
+                    channel
+                ] = np.asarray(channel_image)
+    # the negative lobes of LANCZOS must not leave colour without alpha
+    resized = np.clip(resized, 0, 1)
+    resized[..., :3] = np.minimum(resized[..., :3], resized[..., 3:4])
+    return resized
+
+def resize_cells(pixels, cell_width, cell_height, new_cell_width, new_cell_height):
+    # pixels: a grid sheet of cell_width x cell_height cells
+    premultiplied = premultiply(pixels)
+    if cell_width % new_cell_width == 0 and cell_height % new_cell_height == 0:
+        resized = box_downsample(
+            premultiplied,
+            cell_width,
+            cell_height,
+            cell_width // new_cell_width,
+            cell_height // new_cell_height
+        )
+    else:
+        resized = filter_downsample(premultiplied, cell_width, cell_height, new_cell_width, new_cell_height)
+    return unpremultiply(resized)
+
+def count_mip_levels(cell_width, cell_height):
+    n_levels = 0
+    while cell_width % 2 == 0 and cell_height % 2 == 0:
+        cell_width //= 2
+        cell_height //= 2
+        n_levels += 1
+    return n_levels
+
+def make_mip_chain(pixels, cell_width, cell_height):
+    # halves the cells while their size stays even, level 0 (pixels) excluded.
+    # Each level is made from the unrounded previous one.
+    levels = []
+    premultiplied = premultiply(pixels)
+    while cell_width % 2 == 0 and cell_height % 2 == 0:
+        premultiplied = box_downsample(premultiplied, cell_width, cell_height, 2, 2)
+        cell_width //= 2
+        cell_height //= 2
+        levels.append(unpremultiply(premultiplied))
+    return levels
+
+def load_sheet(sheet_file_path):
+    with Image.open(sheet_file_path) as image:
+        return np.asarray(image.convert('RGBA'))
+
+def get_scaled_sheet_path(sheet_file_path, scale):
+    return f'{os.path.splitext(sheet_file_path)[0]}@{scale:g}x.png'
+
+def get_mip_path(sheet_file_path, level):
+    return f'{os.path.splitext(sheet_file_path)[0]}_mip{level}.png'
+
+def make_scaled_sheet(sheet_file_path, cell_width, cell_height, scale, scaled_cell_width, scaled_cell_height):
+    scaled_path = get_scaled_sheet_path(sheet_file_path, scale)
+    print(f'scaled_path: {scaled_path}')
+    pixels = load_sheet(sheet_file_path)
+    compositor.save_sheet(
+        resize_cells(pixels, cell_width, cell_height, scaled_cell_width, scaled_cell_height),
+        scaled_path
+    )
+    return scaled_path
+
+def make_mip_sheets(sheet_file_path, cell_width, cell_height):
+    mip_paths = []
+    for level, pixels in enumerate(make_mip_chain(load_sheet(sheet_file_path), cell_width, cell_height), start=1):
+        mip_path = get_mip_path(sheet_file_path, level)
+        print(f'mip_path: {mip_path}')
+        compositor.save_sheet(pixels, mip_path)
+        mip_paths.append(mip_path)
+    return mip_paths
@@ -0,0 +1,112 @@
+import numpy as np
+import os
+import struct
+import zlib
+
+
+# Writes an RGBA8 png a band of rows at a time, so only the band is ever in
+# memory. Every scanline gets the png filter with the smallest sum of
+# absolute values, the heuristic libpng uses too.
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+BIT_DEPTH = 8
+COLOR_TYPE_RGBA = 6
+BYTES_PER_PIXEL = 4
+COMPRESSION_LEVEL = 6
+# compressed bytes buffered before an IDAT chunk is written
+IDAT_SIZE = 1 << 16
+
+def make_chunk(chunk_type, data):
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+def paeth_predictor(left, up, up_left):
+    estimate = left + up - up_left
+    distance_left = np.abs(estimate - left)
+    distance_up = np.abs(estimate - up)
+    distance_up_left = np.abs(estimate - up_left)
+    return np.where(
+        (distance_left <= distance_up) & (distance_left <= distance_up_left),
+        left,
+        np.where(distance_up <= distance_up_left, up, up_left)
+    )
+
+def filter_scanlines(scanlines, previous_scanline):
+    # scanlines: (n_rows, width * 4) uint8, previous_scanline: the row above
+    # the first one, zeros at the top of the image.
+    # Filters only read the unfiltered bytes, so every row is done at once.
+    current = scanlines.astype(np.int16)
+    up = np.vstack([previous_scanline[None, :].astype(np.int16), current[:-1]])
+    left = np.zeros_like(current)
+    left[:, BYTES_PER_PIXEL:] = current[:, :-BYTES_PER_PIXEL]
+    up_left = np.zeros_like(current)
+    up_left[:, BYTES_PER_PIXEL:] = up[:, :-BYTES_PER_PIXEL]
+
+    # in the order of the png filter types: none, sub, up, average, paeth
+    candidates = np.stack([
+        current,
+        current - left,
+        current - up,
+        current - (left + up) // 2,
+        current - paeth_predictor(left, up, up_left),
+    ]).astype(np.uint8)
+    # the bytes read as signed values, like libpng
+    costs = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+    filter_types = costs.argmin(axis=0)
+    filtered = candidates[filter_types, np.arange(scanlines.shape[0])]
+    return np.hstack([filter_types.astype(np.uint8)[:, None], filtered])
+
+class PngStreamWriter:
+    def __init__(self, path, width, height, compression_level=COMPRESSION_LEVEL):
+        self.path = path
+        self.temp_path = f'{path}.tmp'
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.previous_scanline = np.zeros(width * BYTES_PER_PIXEL, dtype=np.uint8)
+        self.compressor = zlib.compressobj(compression_level)
+        self.pending = bytearray()
+        self.file = open(self.temp_path, 'wb')
+        self.file.write(PNG_SIGNATURE)
+        self.file.write(make_chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', width, height, BIT_DEPTH, COLOR_TYPE_RGBA, 0, 0, 0
+        )))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.rows_written == self.height:
+            self.close()
+            return
+        self.file.close()
+        os.remove(self.temp_path)
+        if exc_type is None:
+            raise ValueError(f'{self.rows_written} of {self.height} rows written')
+
+    def write_rows(self, pixels):
+        # pixels: (n_rows, width, 4) uint8, the next rows of the image
+        if pixels.shape[1:] != (self.width, BYTES_PER_PIXEL):
+            raise ValueError(f'rows of {pixels.shape[1]} pixels in a {self.width} pixels wide png')
+        if self.rows_written + pixels.shape[0] > self.height:
+            raise ValueError(f'more than {self.height} rows written')
+        scanlines = np.ascontiguousarray(pixels, dtype=np.uint8).reshape(pixels.shape[0], -1)
+        filtered = filter_scanlines(scanlines, self.previous_scanline)
+        self.previous_scanline = scanlines[-1].copy()
+        self.rows_written += pixels.shape[0]
+        self.pending += self.compressor.compress(filtered.tobytes())
+        self.flush_chunks()
+
+    def flush_chunks(self, final=False):
+        while len(self.pending) >= IDAT_SIZE:
+            self.file.write(make_chunk(b'IDAT', bytes(self.pending[:IDAT_SIZE])))
+            del self.pending[:IDAT_SIZE]
+        if final and self.pending:
+            self.file.write(make_chunk(b'IDAT', bytes(self.pending)))
+            self.pending.clear()
+
+    def close(self):
+        self.pending += self.compressor.flush()
+        self.flush_chunks(final=True)
+        self.file.write(make_chunk(b'IEND', b''))
+        self.file.close()
+        os.replace(self.temp_path, self.path)
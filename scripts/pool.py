@@ -0,0 +1,68 @@
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+
+
+BLENDER_ENV = "BLENDER"
+OUTPUT_TAIL_LINES = 20
+RESULT_PREFIX = "WORKER_RESULT:"
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+
+class JobResult:
+    def __init__(self, name, returncode, output, result):
+        self.name = name
+        self.returncode = returncode
+        self.output = output
+        self.result = result
+
+    def succeeded(self):
+        return self.returncode == 0
+
+    def output_tail(self):
+        return "\n".join(self.output.splitlines()[-OUTPUT_TAIL_LINES:])
+
+def make_worker_command(job):
+    # workers are background Blender processes: either the blender binary from
+    # the BLENDER env variable, or this interpreter when bpy is a python module.
+    # They load the user preferences like a serial run, so Cycles renders on
+    # the same compute device with the same add-ons
+    job_json = json.dumps(job)
+    blender = os.environ.get(BLENDER_ENV)
+    if blender:
+        return [blender, '-b', '-P', WORKER_SCRIPT, '--', job_json]
+    return [sys.executable, WORKER_SCRIPT, job_json]
+
+def run_command(name, command):
+    completed = subprocess.run(command, capture_output=True, text=True)
+    result = None
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+    return JobResult(name, completed.returncode, completed.stdout + completed.stderr, result)
+
+def run_commands(named_commands, n_workers):
+    # results come back in the same order as named_commands, whatever order they finish in
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(run_command, name, command) for name, command in named_commands]
+        results = []
+        for future in futures:
+            result = future.result()
+            status = 'ok' if result.succeeded() else f'failed ({result.returncode})'
+            print(f'job {result.name}: {status}')
+            results.append(result)
+    return results
+
+def run_worker_jobs(jobs, n_workers):
+    named_commands = [(job['name'], make_worker_command(job)) for job in jobs]
+    return run_commands(named_commands, n_workers)
+
+def report_failures(results):
+    failed = [result for result in results if not result.succeeded()]
+    for result in failed:
+        print(f'job {result.name} failed with exit code {result.returncode}:')
+        print(result.output_tail())
+    if failed:
+        names = ", ".join(result.name for result in failed)
+        raise RuntimeError(f'{len(failed)} of {len(results)} jobs failed: {names}')
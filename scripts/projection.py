@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def get_view_frame(scene, camera):
+    # the first three corners of camera.data.view_frame, in camera space:
+    # top right, bottom right, bottom left
+    view_frame = camera.data.view_frame(scene=scene)
+    return np.array([list(corner) for corner in view_frame[:3]])
+
+def get_is_ortho(camera):
+    return camera.data.type == 'ORTHO'
+
+def normalize_matrices(matrices):
+    # same as mathutils.Matrix.normalized(): unit length axes, no scale
+    normalized = np.array(matrices, dtype=np.float64)
+    axes_length = np.linalg.norm(normalized[..., :3, :3], axis=-2, keepdims=True)
+    normalized[..., :3, :3] /= axes_length
+    return normalized
+
+def to_homogeneous(points):
+    points = np.asarray(points, dtype=np.float64)
+    ones = np.ones(points.shape[:-1] + (1,))
+    return np.concatenate([points, ones], axis=-1)
+
+def transform_points(matrices, points):
+    # matrices (..., 4, 4) and points (..., 3) broadcast against each other
+    transformed = np.einsum('...ij,...j->...i', matrices, to_homogeneous(points))
+    return transformed[..., :3]
+
+def world_to_camera_view(camera_matrices, view_frame, is_ortho, points):
+    # vectorized bpy_extras.object_utils.world_to_camera_view:
+    # camera_matrices is one (4, 4) camera matrix_world or one per point (n, 4, 4),
+    # points are world locations (n, 3). Returns (n, 3): x and y between 0 and 1
+    # across the camera frame, and the depth in front of the camera as z.
+    camera_inverse = np.linalg.inv(normalize_matrices(camera_matrices))
+    co_local = transform_points(camera_inverse, points)
+    z = -co_local[..., 2]
+
+    top_right, bottom_right, bottom_left = view_frame
+    if is_ortho:
+        min_x, max_x = bottom_left[0], bottom_right[0]
+        min_y, max_y = bottom_right[1], top_right[1]
+    else:
+        # perspective frames are scaled to the depth of each point
+        with np.errstate(divide='ignore', invalid='ignore'):
+            min_x = -bottom_left[0] * z / bottom_left[2]
+            max_x = -bottom_right[0] * z / bottom_right[2]
+            min_y = -bottom_right[1] * z / bottom_right[2]
+            max_y = -top_right[1] * z / top_right[2]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (co_local[..., 0] - min_x) / (max_x - min_x)
+        y = (co_local[..., 1] - min_y) / (max_y - min_y)
+    coords = np.stack([x, y, z], axis=-1)
+    if not is_ortho:
+        coords[z == 0.0] = [0.5, 0.5, 0.0]
+    return coords
@@ -0,0 +1,98 @@
+import common
+import hashlib
+import os
+
+
+# Writes files into the game repo only when their content changed, through a
+# temp file and a rename, so the game never reads half a file and its asset
+# hot reload only fires for real changes.
+HASH_CHUNK_SIZE = 1024 * 1024
+# larger pngs are published when their bytes differ, instead of decoding both
+# whole, which the streaming sheet backend avoids
+PIXEL_COMPARE_MAX_PIXELS = 2048 * 2048
+PUBLISHED = "published"
+UNCHANGED = "unchanged"
+
+class PublishReport:
+    def __init__(self):
+        # (target_path, status) of every file published in this process
+        self.entries = []
+
+    def add(self, target_path, status):
+        print(f'{status}: {target_path}')
+        self.entries.append((target_path, status))
+
+    def print_summary(self):
+        published = [target_path for target_path, status in self.entries if status == PUBLISHED]
+        print(f'published {len(published)} of {len(self.entries)} files')
+        for target_path in published:
+            print(f'  {target_path}')
+
+REPORT = PublishReport()
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def has_same_pixels(source_path, target_path):
+    # a png encoded again can differ in bytes and still show the same image
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(source_path) as source, Image.open(target_path) as target:
+        # only the headers are read so far
+        if source.size != target.size or source.width * source.height > PIXEL_COMPARE_MAX_PIXELS:
+            return False
+        return np.array_equal(np.asarray(source.convert('RGBA')), np.asarray(target.convert('RGBA')))
+
+def is_unchanged(source_path, target_path):
+    if not os.path.exists(target_path):
+        return False
+    if os.path.getsize(source_path) == os.path.getsize(target_path) and hash_file(source_path) == hash_file(target_path):
+        return True
+    return source_path.endswith('.png') and has_same_pixels(source_path, target_path)
+
+def replace_atomically(target_path, write):
+    # the temp file is in the target dir, so the rename never crosses file systems
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    temp_path = f'{target_path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, target_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def publish_file(source_path, target_path):
+    with common.span('publish', target_path=target_path):
+        if is_unchanged(source_path, target_path):
+            status = UNCHANGED
+        else:
+            def copy(f):
+                with open(source_path, 'rb') as source:
+                    for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+                        f.write(chunk)
+            replace_atomically(target_path, copy)
+            status = PUBLISHED
+    REPORT.add(target_path, status)
+    return status
+
+def publish_bytes(data, target_path):
+    with common.span('publish', target_path=target_path):
+        if os.path.exists(target_path) and os.path.getsize(target_path) == len(data) \
+                and hash_file(target_path) == hashlib.sha256(data).hexdigest():
+            status = UNCHANGED
+        else:
+            replace_atomically(target_path, lambda f: f.write(data))
+            status = PUBLISHED
+    REPORT.add(target_path, status)
+    return status
+
+def print_report():
+    REPORT.print_summary()
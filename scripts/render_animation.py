@@ -1,8 +1,10 @@
 import argparse
-import bpy
+import cache
 import common
 import os
+import pool
 import sheet
+import worker
 
 
 ATLAS_MOVING = "moving"
@@ -15,9 +17,28 @@ def parse_arguments():
     parser.add_argument('--n_frames', type=int, default=24)
     parser.add_argument('--render_animations', action='store_true')
     parser.add_argument('--render_sheet', action='store_true')
+    parser.add_argument('--render_profile', type=str, choices=list(common.RENDER_PROFILES), default=common.RENDER_PROFILE_FINAL, help='preview renders fast, and its sheets are never published')
+    parser.add_argument('--supersample', type=int, default=None, help='render at the sheet cell size times this, instead of the .blend resolution')
+    parser.add_argument('--use_cache', action='store_true', help='only render directions whose inputs changed')
+    parser.add_argument('--workers', type=int, default=1, help='number of background Blender processes rendering directions')
+    parser.add_argument('--shards', type=int, default=1, help='number of frame ranges each direction is split into across workers')
+    sheet.add_sheet_arguments(parser)
     return parser.parse_args()
 
-def render_blender_file(file, root_output_dir, render_animations, n_frames):
+def get_direction_cache_key(render_cache, file, n_frames, render_settings=None):
+    return render_cache.make_key(file, n_frames=n_frames, **common.get_render_cache_settings(render_settings))
+
+def is_direction_cached(render_cache, file, output_dir, n_frames, render_settings=None):
+    directions = file.split(".")[0][-5:]
+    key = get_direction_cache_key(render_cache, file, n_frames, render_settings)
+    output_paths = [output_dir.joinpath(filename) for filename in common.prepare_frame_filenames(n_frames)]
+    return render_cache.is_fresh(directions, key, output_paths)
+
+def render_blender_file(file, root_output_dir, render_animations, n_frames, render_cache=None, frame_start=1, frame_end=None, render_settings=None, save_source=True):
+    # frame_start and frame_end render only part of the animation, n_frames is
+    # still the length of the whole animation
+    frame_end = frame_end or n_frames
+    is_whole_animation = frame_start == 1 and frame_end == n_frames
     directions = file.split(".")[0][-5:]
     output_dir = root_output_dir.joinpath(f'{directions}')
     print(f'output_dir: {output_dir}')
@@ -25,28 +46,102 @@ def render_blender_file(file, root_output_dir, render_animations, n_frames):
         os.makedirs(output_dir, exist_ok=False)
 
     if render_animations:
-        bpy.ops.wm.open_mainfile(filepath=file)
+        import bpy
+
+        if render_cache and is_direction_cached(render_cache, file, output_dir, n_frames, render_settings):
+            print(f'cached: {directions}')
+            return output_dir
+        with common.span('open_mainfile', file=file):
+            bpy.ops.wm.open_mainfile(filepath=file)
+        common.apply_render_settings(render_settings)
         bpy.context.scene.render.filepath = f'{output_dir.as_posix()}/'
-        bpy.context.scene.frame_start = 1
-        bpy.context.scene.frame_end = n_frames
-        bpy.ops.render.render(animation=True)
-        bpy.ops.wm.save_as_mainfile(filepath=bpy.data.filepath)
+        bpy.context.scene.frame_start = frame_start
+        bpy.context.scene.frame_end = frame_end
+        with common.span('render', direction=directions, frames=f'{frame_start}-{frame_end}'):
+            bpy.ops.render.render(animation=True)
+        common.write_render_metadata(output_dir, render_settings)
+        if not is_whole_animation:
+            # part of the frames only: nothing to cache, and saving would
+            # store a partial frame range in the source file
+            return output_dir
+        if render_cache:
+            # saving would change the .blend hash the cache key is made of
+            render_cache.store(directions, get_direction_cache_key(render_cache, file, n_frames, render_settings))
+        elif save_source and common.should_save_source(render_settings):
+            with common.span('save_as_mainfile', file=file):
+                bpy.ops.wm.save_as_mainfile(filepath=bpy.data.filepath)
     return output_dir
 
+def render_blender_files_in_workers(files_to_render, root_output_dir, n_frames, n_workers, render_cache=None, n_shards=1, render_settings=None):
+    jobs = []
+    for file in files_to_render:
+        directions = file.split(".")[0][-5:]
+        output_dir = root_output_dir.joinpath(f'{directions}')
+        os.makedirs(output_dir, exist_ok=True)
+        if render_cache and is_direction_cached(render_cache, file, output_dir, n_frames, render_settings):
+            print(f'cached: {directions}')
+            continue
+        for frame_start, frame_end in common.shard_frame_range(n_frames, n_shards):
+            jobs.append({
+                'kind': worker.KIND_RENDER_DIRECTION,
+                'name': f'{directions}:{frame_start}-{frame_end}',
+                'directions': directions,
+                'file': file,
+                'root_output_dir': str(root_output_dir),
+                'n_frames': n_frames,
+                'frame_start': frame_start,
+                'frame_end': frame_end,
+                'render_settings': render_settings.to_dict() if render_settings else None,
+                # like a serial run: with the cache the source is never saved
+                'save_source': render_cache is None,
+            })
+    results = pool.run_worker_jobs(jobs, n_workers)
+    if render_cache:
+        # the cache file is only written here, never by the workers,
+        # and only for directions whose shards all succeeded
+        failed = set(job['directions'] for job, result in zip(jobs, results) if not result.succeeded())
+        for job in jobs:
+            if job['directions'] not in failed and job['frame_start'] == 1:
+                render_cache.store(job['directions'], get_direction_cache_key(render_cache, job['file'], n_frames, render_settings))
+    pool.report_failures(results)
+
+    direction_paths = [root_output_dir.joinpath(file.split(".")[0][-5:]) for file in files_to_render]
+    common.check_frames_complete(direction_paths, n_frames)
+    return direction_paths
+
 
 def main():
     args = parse_arguments()
+    common.set_trace_tags(item=args.item, version=args.version)
     renders_dir = common.get_or_create_renders_dir(args.item, args.version)
     files_to_render = common.find_files_to_render(args.item, args.version)
+    render_cache = cache.RenderCache(renders_dir) if args.use_cache else None
+    render_settings = common.RenderSettings.for_sprite(args.item, sheet.Sheet.EXTRA_SCALE, args.supersample, args.render_profile)
     direction_paths = []
-    for file in files_to_render:
-        direction_path = render_blender_file(
-            file,
+    if args.render_animations and (args.workers > 1 or args.shards > 1):
+        direction_paths = render_blender_files_in_workers(
+            files_to_render,
             renders_dir,
-            args.render_animations,
-            args.n_frames
+            args.n_frames,
+            args.workers,
+            render_cache,
+            args.shards,
+            render_settings
         )
-        direction_paths.append(direction_path)
+    else:
+        for file in files_to_render:
+            direction_path = render_blender_file(
+                file,
+                renders_dir,
+                args.render_animations,
+                args.n_frames,
+                render_cache,
+                render_settings=render_settings
+            )
+            direction_paths.append(direction_path)
+    if args.render_only:
+        common.write_trace('render_animation')
+        return
     render_filenames = common.prepare_frame_filenames(args.n_frames)
     sprite_sheet = sheet.Sheet(
         item=args.item,
@@ -57,9 +152,16 @@ def main():
         render_dirs=direction_paths,
         render_filenames=render_filenames,
         is_animation=True,
-        atlas_kind=ATLAS_MOVING
+        atlas_kind=ATLAS_MOVING,
+        backend=args.sheet_backend,
+        layout=args.sheet_layout,
+        dedup_tolerance=args.dedup_tolerance,
+        texture_compression=args.texture_compression,
+        scales=args.sheet_scales,
+        mips=args.sheet_mips,
     )
     sprite_sheet.make_render_and_copy()
+    common.write_trace('render_animation')
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import argparse
+import cache
 import common
 import construction
 import sheet
@@ -23,26 +24,67 @@ def parse_arguments():
     parser.add_argument('--n_frames', type=int, default=24)
     parser.add_argument('--render_animations', action='store_true')
     parser.add_argument('--render_sheet', action='store_true')
+    parser.add_argument('--reveal', type=str, choices=construction.REVEALS, default=construction.REVEAL_BOOLEAN, help=f'{construction.REVEAL_ALPHA_CLIP} is the fastest, but does not cut the line art')
+    parser.add_argument('--compare_reveals', action='store_true', help='time every reveal on the first model and exit')
+    parser.add_argument('--workers', type=int, default=1, help='number of background Blender processes rendering animations')
+    parser.add_argument('--shards', type=int, default=1, help='number of frame ranges each animation is split into across workers')
+    parser.add_argument('--render_profile', type=str, choices=list(common.RENDER_PROFILES), default=common.RENDER_PROFILE_FINAL, help='preview renders fast, and its sheets are never published')
+    parser.add_argument('--supersample', type=int, default=None, help='render at the sheet cell size times this, instead of the .blend resolution')
+    parser.add_argument('--use_cache', action='store_true', help='only render degrees whose inputs changed')
+    sheet.add_sheet_arguments(parser)
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
+    common.set_trace_tags(item=args.item, version=args.filename)
     model_path = common.get_model_path(args.item, args.filename)
     renders_dir = common.get_or_create_renders_dir(args.item, args.filename)
-    degree_paths = []
-    for degree in common.DEGREES:
-        output_dir = renders_dir.joinpath(f'{degree}')
-        degree_path = construction.render_animations(
+    if args.compare_reveals:
+        construction.compare_reveals(
             args.item,
             model_path,
-            output_dir,
-            degree,
-            args.render_animations,
+            renders_dir.joinpath(construction.REVEAL_COMPARISON),
+            common.DEGREES[0],
+            args.n_frames,
+            COLLECTIONS[args.item],
+        )
+        common.write_trace('render_industry_constructions')
+        return
+    render_cache = cache.RenderCache(renders_dir) if args.use_cache else None
+    render_settings = common.RenderSettings.for_sprite(args.item, sheet.Sheet.EXTRA_SCALE, args.supersample, args.render_profile)
+    degree_paths = []
+    if args.render_animations and (args.workers > 1 or args.shards > 1):
+        degree_paths = construction.render_animations_in_workers(
+            args.item,
+            [(model_path, renders_dir.joinpath(f'{degree}'), degree) for degree in common.DEGREES],
             args.n_frames,
             COLLECTIONS[args.item],
+            args.workers,
+            args.shards,
+            render_cache,
+            args.reveal,
+            render_settings,
         )
-        degree_paths.append(degree_path)
+    else:
+        for degree in common.DEGREES:
+            output_dir = renders_dir.joinpath(f'{degree}')
+            degree_path = construction.render_animations(
+                args.item,
+                model_path,
+                output_dir,
+                degree,
+                args.render_animations,
+                args.n_frames,
+                COLLECTIONS[args.item],
+                render_cache,
+                args.reveal,
+                render_settings=render_settings,
+            )
+            degree_paths.append(degree_path)
+    if args.render_only:
+        common.write_trace('render_industry_constructions')
+        return
     render_filenames = common.prepare_frame_filenames(args.n_frames)
     sprite_sheet = sheet.Sheet(
         item=args.item,
@@ -53,9 +95,16 @@ def main():
         render_dirs=degree_paths,
         render_filenames=render_filenames,
         is_animation=True,
-        atlas_kind=construction.ATLAS_CONSTRUCTION
+        atlas_kind=construction.ATLAS_CONSTRUCTION,
+        backend=args.sheet_backend,
+        layout=args.sheet_layout,
+        dedup_tolerance=args.dedup_tolerance,
+        texture_compression=args.texture_compression,
+        scales=args.sheet_scales,
+        mips=args.sheet_mips,
     )
     sprite_sheet.make_render_and_copy()
+    common.write_trace('render_industry_constructions')
 
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 import argparse
-import bpy
+import cache
 import common
 import math
 import os
@@ -14,40 +14,119 @@ def parse_arguments():
     parser.add_argument('filename', type=str, help='name of the file to use')
     parser.add_argument('--render_degrees', action='store_true')
     parser.add_argument('--render_sheet', action='store_true')
+    parser.add_argument('--single_session', action='store_true', help='open the model once for every degree and never save it')
+    parser.add_argument('--render_profile', type=str, choices=list(common.RENDER_PROFILES), default=common.RENDER_PROFILE_FINAL, help='preview renders fast, and its sheets are never published')
+    parser.add_argument('--supersample', type=int, default=None, help='render at the sheet cell size times this, instead of the .blend resolution')
+    parser.add_argument('--use_cache', action='store_true', help='only render degrees whose inputs changed')
+    sheet.add_sheet_arguments(parser)
     return parser.parse_args()
 
-def render_model(model_path, renders_dir, degree, render_degrees):
+def get_degree_cache_key(render_cache, model_path, degree, render_settings=None):
+    return render_cache.make_key(model_path, degree=degree, **common.get_render_cache_settings(render_settings))
+
+def render_model(model_path, renders_dir, degree, render_degrees, render_cache=None, render_settings=None):
     output_filename = f'{degree:03d}.png'
     render_path = os.path.join(renders_dir, output_filename)
     print(f'output_dir: {render_path}')
 
     if render_degrees:
-        bpy.ops.wm.open_mainfile(filepath=model_path)
+        import bpy
+
+        if render_cache:
+            key = get_degree_cache_key(render_cache, model_path, degree, render_settings)
+            if render_cache.is_fresh(output_filename, key, [render_path]):
+                print(f'cached: {output_filename}')
+                return output_filename
+        with common.span('open_mainfile', file=model_path):
+            bpy.ops.wm.open_mainfile(filepath=model_path)
+        common.apply_render_settings(render_settings)
         bpy.context.scene.render.filepath = render_path
 
         common.set_object_as_active(common.EMPTY_ORIGIN)
         bpy.context.active_object.rotation_euler[2] = math.radians(degree)
 
-        bpy.ops.render.render(write_still=True)
+        with common.span('render', degree=degree):
+            bpy.ops.render.render(write_still=True)
+        common.write_render_metadata(render_path, render_settings)
         if degree == common.DEGREES[-1]:
             bpy.context.active_object.rotation_euler[2] = math.radians(0)
-        bpy.ops.wm.save_as_mainfile(filepath=bpy.data.filepath)
+        if render_cache:
+            # saving would change the .blend hash the cache key is made of
+            render_cache.store(output_filename, key)
+        elif common.should_save_source(render_settings):
+            with common.span('save_as_mainfile', file=model_path):
+                bpy.ops.wm.save_as_mainfile(filepath=bpy.data.filepath)
     return output_filename
 
+def render_model_in_single_session(model_path, renders_dir, degrees, render_degrees, render_cache=None, render_settings=None):
+    output_filenames = [f'{degree:03d}.png' for degree in degrees]
+    if not render_degrees:
+        return output_filenames
+
+    to_render = []
+    for degree, output_filename in zip(degrees, output_filenames):
+        render_path = os.path.join(renders_dir, output_filename)
+        print(f'output_dir: {render_path}')
+        key = get_degree_cache_key(render_cache, model_path, degree, render_settings) if render_cache else None
+        if render_cache and render_cache.is_fresh(output_filename, key, [render_path]):
+            print(f'cached: {output_filename}')
+            continue
+        to_render.append((degree, render_path, output_filename, key))
+    if not to_render:
+        return output_filenames
+
+    import bpy
+
+    with common.span('open_mainfile', file=model_path):
+        bpy.ops.wm.open_mainfile(filepath=model_path)
+    common.apply_render_settings(render_settings)
+    common.set_object_as_active(common.EMPTY_ORIGIN)
+    origin = bpy.context.active_object
+    original_rotation = origin.rotation_euler[2]
+    for degree, render_path, output_filename, key in to_render:
+        bpy.context.scene.render.filepath = render_path
+        origin.rotation_euler[2] = math.radians(degree)
+        with common.span('render', degree=degree):
+            bpy.ops.render.render(write_still=True)
+        common.write_render_metadata(render_path, render_settings)
+        if render_cache:
+            render_cache.store(output_filename, key)
+    # only restored in memory, the source .blend is never written back
+    origin.rotation_euler[2] = original_rotation
+    return output_filenames
+
 
 def main():
     args = parse_arguments()
+    common.set_trace_tags(item=args.item, version=args.filename)
     model_path =common.get_model_path(args.item, args.filename)
     renders_dir = common.get_or_create_renders_dir(args.item, args.filename)
+    render_cache = cache.RenderCache(renders_dir) if args.use_cache else None
+    render_settings = common.RenderSettings.for_sprite(args.item, sheet.Sheet.EXTRA_SCALE, args.supersample, args.render_profile)
     degree_filenames = []
-    for degree in common.DEGREES:
-        degree_filename = render_model(
+    if args.single_session:
+        degree_filenames = render_model_in_single_session(
             model_path,
             renders_dir,
-            degree,
+            common.DEGREES,
             args.render_degrees,
+            render_cache,
+            render_settings,
         )
-        degree_filenames.append(degree_filename)
+    else:
+        for degree in common.DEGREES:
+            degree_filename = render_model(
+                model_path,
+                renders_dir,
+                degree,
+                args.render_degrees,
+                render_cache,
+                render_settings,
+            )
+            degree_filenames.append(degree_filename)
+    if args.render_only:
+        common.write_trace('render_rotatable_buildings')
+        return
     sprite_sheet = sheet.Sheet(
         item=args.item,
         version=args.filename,
@@ -57,9 +136,16 @@ def main():
         render_dirs=[renders_dir],
         render_filenames=degree_filenames,
         is_animation=False,
-        atlas_kind=ATLAS_VARIETY
+        atlas_kind=ATLAS_VARIETY,
+        backend=args.sheet_backend,
+        layout=args.sheet_layout,
+        dedup_tolerance=args.dedup_tolerance,
+        texture_compression=args.texture_compression,
+        scales=args.sheet_scales,
+        mips=args.sheet_mips,
     )
     sprite_sheet.make_render_and_copy()
+    common.write_trace('render_rotatable_buildings')
 
 
 if __name__ == "__main__":
@@ -1,12 +1,18 @@
-import bpy
 import common
 import os
 import math
 import pathlib
-import shutil
 
 
 class Sheet:
+    BACKEND_BLENDER = "blender"
+    BACKEND_COMPOSITOR = "compositor"
+    BACKEND_STREAMING = "streaming"
+    BACKENDS = [BACKEND_COMPOSITOR, BACKEND_STREAMING, BACKEND_BLENDER]
+    LAYOUT_ATLAS = "atlas"
+    LAYOUT_DEDUP = "dedup"
+    LAYOUT_GRID = "grid"
+    LAYOUTS = [LAYOUT_GRID, LAYOUT_ATLAS, LAYOUT_DEDUP]
     SHEETS = "sprite_sheets"
     TEMPLATE = "template.blend"
     ASSET_TEXTURES = "assets/textures/"
@@ -23,6 +29,12 @@ class Sheet:
             render_filenames: list[str],
             is_animation: bool,
             atlas_kind: str,
+            backend: str=BACKEND_COMPOSITOR,
+            layout: str=LAYOUT_GRID,
+            dedup_tolerance: int=0,
+            texture_compression: str=None,
+            scales: list[float]=None,
+            mips: bool=False,
         ):
         self.item = item
         self.version = version
@@ -38,15 +50,61 @@ class Sheet:
         # and filenames as rows.
         self.is_animation = is_animation
         self.atlas_kind = atlas_kind
+        # backend: compositor blits the frame pngs straight into one array,
+        # streaming writes the png one row of cells at a time, so only that
+        # row is in memory, blender renders them on a grid of planes from the template.blend
+        self.backend = backend
+        # layout: grid keeps one full SpriteSize cell per frame, atlas trims
+        # every frame to its alpha bounding box and packs them into pages,
+        # dedup stores identical frames once and maps the cells to them
+        self.layout = layout
+        # dedup_tolerance: largest channel difference (0-255) between two
+        # frames considered the same by the dedup layout
+        self.dedup_tolerance = dedup_tolerance
+        # texture_compression: quality of the BC3 DDS written next to every
+        # png of the sheet, None only ships the pngs
+        self.texture_compression = texture_compression
+        # scales: extra_scale of SpriteSize of the extra sheets made from the
+        # same frames, smaller than EXTRA_SCALE.
+        # mips: also writes the mip chain of each sheet, and stores it in the DDS
+        self.scales = scales or []
+        self.mips = mips
+
+    def get_image_path(self, col, row):
+        if self.is_animation:
+            file_dir = self.render_dirs[row]
+            file_name = self.render_filenames[col]
+        else:
+            file_dir = self.render_dirs[col]
+            file_name = self.render_filenames[row]
+        return os.path.join(file_dir, file_name)
+
+    def get_cells(self):
+        for row in range(self.n_rows):
+            for col in range(self.n_cols):
+                yield col, row, self.get_image_path(col, row)
+
+    def get_sheet_file_path(self, extension='png'):
+        blender_dir = common.get_blender_dir()
+        # one folder per atlas_kind: industries make a construction and a
+        # variety sheet from the same model, with the same file name
+        item_dir = blender_dir.joinpath(f'{self.SHEETS}/{self.item}/{self.atlas_kind}/')
+        sheet_file_name = f'{self.item}_{self.version}.{extension}'
+        return os.path.join(item_dir, sheet_file_name)
 
     def open_sprite_sheet_template(self):
+        import bpy
+
         blender_dir = common.get_blender_dir()
         sheets_dir = blender_dir.joinpath(f'{self.SHEETS}/')
         template = os.path.join(sheets_dir, f'{self.TEMPLATE}')
         print(f'template: {template}')
-        bpy.ops.wm.open_mainfile(filepath=template)
+        with common.span('open_mainfile', file=template):
+            bpy.ops.wm.open_mainfile(filepath=template)
 
     def setup_camera_and_meshes(self):
+        import bpy
+
         bpy.data.objects['Camera'].select_set(True)
         bpy.ops.object.delete()
         bpy.ops.object.camera_add(rotation=(math.radians(90), 0, 0))
@@ -103,6 +161,8 @@ class Sheet:
         bpy.ops.mesh.separate(type='LOOSE')
 
     def setup_materials(self):
+        import bpy
+
         row = 0
         col = 0
         for _name, object in bpy.context.view_layer.objects.items():
@@ -120,18 +180,12 @@ class Sheet:
             nodes = material.node_tree.nodes
             node_principled = nodes.get('Principled BSDF')
 
-            if self.is_animation:
-                file_dir = self.render_dirs[row]
-                file_name = self.render_filenames[col]
-            else:
-                file_dir = self.render_dirs[col]
-                file_name = self.render_filenames[row]
-            
-            image_path = os.path.join(file_dir, file_name)
+            image_path = self.get_image_path(col, row)
             print(f'image_path: {image_path}')
 
             node_texture = nodes.new('ShaderNodeTexImage')
-            node_texture.image = bpy.data.images.load(image_path)
+            with common.span('load_frame', image_path=image_path):
+                node_texture.image = bpy.data.images.load(image_path)
 
             node_output = nodes.get('Material Output')
 
@@ -146,38 +200,230 @@ class Sheet:
                 row += 1
 
     def render_sprite_sheet(self):
-        blender_dir = common.get_blender_dir()
-        item_dir = blender_dir.joinpath(f'{self.SHEETS}/{self.item}/')
-        blender_file_name = f'{self.item}_{self.version}.blend'
-        blender_file_path = os.path.join(item_dir, blender_file_name)
+        import bpy
+
+        blender_file_path = self.get_sheet_file_path('blend')
         print(f'blender_file_path: {blender_file_path}')
 
-        sheet_file_name = f'{self.item}_{self.version}.png'
-        sheet_file_path = os.path.join(item_dir, sheet_file_name)
+        sheet_file_path = self.get_sheet_file_path()
         print(f'sheet_file_path: {sheet_file_path}')
 
         if self.render_sheet:
             bpy.context.scene.render.filepath = sheet_file_path
-            bpy.ops.render.render(write_still=True)
-            bpy.ops.wm.save_as_mainfile(filepath=blender_file_path)
+            with common.span('sheet_render', item=self.item, version=self.version):
+                bpy.ops.render.render(write_still=True)
+            with common.span('save_as_mainfile', file=blender_file_path):
+                bpy.ops.wm.save_as_mainfile(filepath=blender_file_path)
         return sheet_file_path
 
+    def composite_sprite_sheet(self):
+        import compositor
+
+        sheet_file_path = self.get_sheet_file_path()
+        print(f'sheet_file_path: {sheet_file_path}')
+
+        if self.render_sheet:
+            sprite_sheet = compositor.composite_sheet(
+                self.get_cells(),
+                self.n_cols,
+                self.n_rows,
+                self.sprite_size.width,
+                self.sprite_size.height,
+            )
+            compositor.save_sheet(sprite_sheet, sheet_file_path)
+        return sheet_file_path
+
+    def stream_sprite_sheet(self):
+        import compositor
+
+        sheet_file_path = self.get_sheet_file_path()
+        print(f'sheet_file_path: {sheet_file_path}')
+
+        if self.render_sheet:
+            compositor.stream_sheet(
+                self.get_cells(),
+                self.n_cols,
+                self.n_rows,
+                self.sprite_size.width,
+                self.sprite_size.height,
+                sheet_file_path,
+            )
+        return sheet_file_path
+
+    def pack_sprite_atlas(self):
+        import atlas
+
+        sheet_file_path = self.get_sheet_file_path()
+        if self.render_sheet:
+            return atlas.make_atlas(
+                self.get_cells(),
+                self.sprite_size.width,
+                self.sprite_size.height,
+                self.is_animation,
+                sheet_file_path,
+            )
+        return atlas.list_atlas_files(sheet_file_path)
+
+    def dedup_sprite_sheet(self):
+        import dedup
+
+        sheet_file_path = self.get_sheet_file_path()
+        print(f'sheet_file_path: {sheet_file_path}')
+
+        if self.render_sheet:
+            return dedup.make_dedup_sheet(
+                self.get_cells(),
+                self.n_cols,
+                self.n_rows,
+                self.sprite_size.width,
+                self.sprite_size.height,
+                self.is_animation,
+                sheet_file_path,
+                self.dedup_tolerance,
+            )
+        return dedup.list_dedup_files(sheet_file_path)
+
+    def check_scalable(self):
+        if self.layout == self.LAYOUT_ATLAS:
+            raise ValueError('scaled sheets and mips need a grid of cells, not an atlas')
+        for scale in self.scales:
+            if scale >= self.EXTRA_SCALE:
+                raise ValueError(f'scale {scale:g} is not smaller than the render scale {self.EXTRA_SCALE}')
+
+    def scale_sprite_sheet(self, image_paths):
+        # returns (path, SpriteSize) of the sheets made at the other scales
+        import mipmaps
+
+        scaled_sheets = []
+        for image_path in image_paths:
+            for scale in self.scales:
+                scaled_size = common.SpriteSize(self.item, scale)
+                scaled_path = mipmaps.get_scaled_sheet_path(image_path, scale)
+                if self.render_sheet:
+                    mipmaps.make_scaled_sheet(
+                        image_path,
+                        self.sprite_size.width,
+                        self.sprite_size.height,
+                        scale,
+                        scaled_size.width,
+                        scaled_size.height,
+                    )
+                scaled_sheets.append((scaled_path, scaled_size))
+        return scaled_sheets
+
+    def make_sprite_sheet_mips(self, sheets):
+        import mipmaps
+
+        mip_paths = []
+        for image_path, sprite_size in sheets:
+            if self.render_sheet:
+                mip_paths += mipmaps.make_mip_sheets(image_path, sprite_size.width, sprite_size.height)
+            else:
+                n_levels = mipmaps.count_mip_levels(sprite_size.width, sprite_size.height)
+                mip_paths += [mipmaps.get_mip_path(image_path, level) for level in range(1, n_levels + 1)]
+        return mip_paths
+
+    def compress_sprite_sheet(self, sheets):
+        import mipmaps
+        import texture_compression
+
+        if not self.render_sheet:
+            return [texture_compression.get_dds_path(image_path) for image_path, _sprite_size in sheets]
+        dds_paths = []
+        for image_path, sprite_size in sheets:
+            mip_levels = []
+            if self.mips:
+                mip_levels = mipmaps.make_mip_chain(
+                    mipmaps.load_sheet(image_path),
+                    sprite_size.width,
+                    sprite_size.height
+                )
+            dds_path, _report = texture_compression.compress_image(image_path, self.texture_compression, mip_levels)
+            dds_paths.append(dds_path)
+        return dds_paths
+
     def copy_sprite_sheet_to_repo(self, sprite_sheet_path):
+        import publish
+
         current_dir = pathlib.Path(os.getcwd())
         target_dir = current_dir.joinpath(f'{self.ASSET_TEXTURES}/{self.atlas_kind}')
         print(f'target_dir: {target_dir}')
 
-        item_filename = sprite_sheet_path.split("\\")[-1]
+        item_filename = os.path.basename(sprite_sheet_path)
         print(f'item_filename: {item_filename}')
 
         target_path = os.path.join(target_dir, item_filename)
         print(f'target_path: {target_path}')
 
-        shutil.copyfile(sprite_sheet_path, target_path)
+        # only changed sheets are written, so the game reloads only those
+        return publish.publish_file(sprite_sheet_path, target_path)
+
+    def make_render(self):
+        # returns the paths of every file of the sheet: one png, or the atlas pages and index
+        if self.layout == self.LAYOUT_ATLAS:
+            with common.span('sheet_atlas', item=self.item, version=self.version):
+                return self.pack_sprite_atlas()
+        if self.layout == self.LAYOUT_DEDUP:
+            with common.span('sheet_dedup', item=self.item, version=self.version):
+                return self.dedup_sprite_sheet()
+        if self.backend == self.BACKEND_COMPOSITOR:
+            with common.span('sheet_composite', item=self.item, version=self.version):
+                return [self.composite_sprite_sheet()]
+        if self.backend == self.BACKEND_STREAMING:
+            with common.span('sheet_stream', item=self.item, version=self.version):
+                return [self.stream_sprite_sheet()]
+        self.open_sprite_sheet_template()
+        with common.span('sheet_setup_camera_and_meshes', item=self.item, version=self.version):
+            self.setup_camera_and_meshes()
+        with common.span('sheet_setup_materials', item=self.item, version=self.version):
+            self.setup_materials()
+        return [self.render_sprite_sheet()]
+
+    def get_unpublishable_profiles(self):
+        # profiles of the frames of this sheet that must not reach the game repo
+        profiles = set()
+        for _col, _row, image_path in self.get_cells():
+            render_settings = common.read_render_settings(image_path)
+            if render_settings and not render_settings.is_publishable():
+                profiles.add(render_settings.profile)
+        return profiles
 
     def make_render_and_copy(self):
-        self.open_sprite_sheet_template()
-        self.setup_camera_and_meshes()
-        self.setup_materials()
-        sprite_sheet_path = self.render_sprite_sheet()
-        self.copy_sprite_sheet_to_repo(sprite_sheet_path)
+        import publish
+
+        if self.scales or self.mips:
+            self.check_scalable()
+        sprite_sheet_paths = self.make_render()
+        # (path, SpriteSize) of the png sheets at every scale
+        image_paths = [path for path in sprite_sheet_paths if path.endswith('.png')]
+        sheets = [(image_path, self.sprite_size) for image_path in image_paths]
+        if self.scales:
+            with common.span('sheet_scale', item=self.item, version=self.version):
+                scaled_sheets = self.scale_sprite_sheet(image_paths)
+            sheets += scaled_sheets
+            sprite_sheet_paths += [image_path for image_path, _sprite_size in scaled_sheets]
+        if self.mips:
+            with common.span('sheet_mips', item=self.item, version=self.version):
+                sprite_sheet_paths += self.make_sprite_sheet_mips(sheets)
+        if self.texture_compression:
+            with common.span('sheet_compress', item=self.item, version=self.version):
+                sprite_sheet_paths += self.compress_sprite_sheet(sheets)
+        unpublishable_profiles = self.get_unpublishable_profiles()
+        if unpublishable_profiles:
+            print(f'not published, frames rendered with {", ".join(sorted(unpublishable_profiles))}:')
+            for sprite_sheet_path in sprite_sheet_paths:
+                print(f'  {sprite_sheet_path}')
+            return
+        for sprite_sheet_path in sprite_sheet_paths:
+            self.copy_sprite_sheet_to_repo(sprite_sheet_path)
+        publish.print_report()
+
+
+def add_sheet_arguments(parser):
+    parser.add_argument('--render_only', action='store_true', help='only render the frames, without making the sheet or copying it to the repo')
+    parser.add_argument('--sheet_backend', type=str, choices=Sheet.BACKENDS, default=Sheet.BACKEND_COMPOSITOR)
+    parser.add_argument('--sheet_layout', type=str, choices=Sheet.LAYOUTS, default=Sheet.LAYOUT_GRID)
+    parser.add_argument('--texture_compression', type=str, choices=['fast', 'normal', 'high'], default=None, help='also ship every sheet png as a BC3 DDS encoded at this quality')
+    parser.add_argument('--sheet_scales', type=float, nargs='+', default=[], help=f'also make the sheets at these SpriteSize extra scales, smaller than {Sheet.EXTRA_SCALE}, from the same frames')
+    parser.add_argument('--sheet_mips', action='store_true', help='also make the mip chain of every sheet')
+    parser.add_argument('--dedup_tolerance', type=int, default=0, help='largest channel difference (0-255) of frames merged by the dedup layout')
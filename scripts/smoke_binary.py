@@ -0,0 +1,143 @@
+import array
+import struct
+import sys
+
+
+# Layout, all little-endian:
+# header: magic (4s), format version (H), kind (B), item (B length + utf-8),
+#         asset version (B length + utf-8)
+# moving: n_directions (B), n_frames (I), then per direction: direction enum (B),
+#         emitter_coords (n_frames * 2 f), smoke_direction (n_frames * 2 f)
+# static: n_degrees (B), then per degree: degree (H), n_emitters (I),
+#         emitter coords (n_emitters * 2 f)
+FORMAT_VERSION = 1
+KIND_MOVING = 0
+KIND_STATIC = 1
+MAGIC = b'SMKB'
+DEGREE_PREFIX = "degree_"
+# largest n_degrees (B) and degree (H) of the static layout
+MAX_STATIC_DEGREES = 0xFF
+MAX_DEGREE = 0xFFFF
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(f'<{fmt}', self.data, self.offset)
+        self.offset += struct.calcsize(f'<{fmt}')
+        return values
+
+    def string(self):
+        (length,) = self.unpack('B')
+        value = self.data[self.offset:self.offset + length].decode('utf-8')
+        self.offset += length
+        return value
+
+    def floats(self, count):
+        values = array.array('f')
+        values.frombytes(self.data[self.offset:self.offset + count * 4])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        self.offset += count * 4
+        return values.tolist()
+
+def pack_string(value):
+    encoded = value.encode('utf-8')
+    return struct.pack('<B', len(encoded)) + encoded
+
+def pack_floats(values):
+    packed = array.array('f', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def pack_header(kind, item, version):
+    return MAGIC + struct.pack('<HB', FORMAT_VERSION, kind) + pack_string(item) + pack_string(version)
+
+def flatten(pairs):
+    return [value for pair in pairs for value in pair]
+
+def pair_up(values):
+    return [values[i:i + 2] for i in range(0, len(values), 2)]
+
+def encode_moving_smoke(item, version, smoke_dict, direction_names):
+    direction_frames = smoke_dict["direction_frames"]
+    n_frames = len(direction_frames[0]["frames"]) if direction_frames else 0
+    chunks = [pack_header(KIND_MOVING, item, version), struct.pack('<BI', len(direction_frames), n_frames)]
+    for direction_frame in direction_frames:
+        frames = direction_frame["frames"]
+        if [frame["frame"] for frame in frames] != list(range(n_frames)):
+            raise ValueError(f'{direction_frame["pair"]["diagonal_pair"]} frames are not 0..{n_frames - 1}')
+        chunks.append(struct.pack('<B', direction_names.index(direction_frame["pair"]["diagonal_pair"])))
+        chunks.append(pack_floats(flatten(frame["emitter_coords"] for frame in frames)))
+        chunks.append(pack_floats(flatten(frame["smoke_direction"] for frame in frames)))
+    return b''.join(chunks)
+
+def encode_static_smoke(item, version, smoke_dict):
+    chunks = [pack_header(KIND_STATIC, item, version), struct.pack('<B', len(smoke_dict))]
+    for key, emitters in smoke_dict.items():
+        degree = int(key[len(DEGREE_PREFIX):])
+        chunks.append(struct.pack('<HI', degree, len(emitters)))
+        chunks.append(pack_floats(flatten(emitters)))
+    return b''.join(chunks)
+
+def decode(data, direction_names=None):
+    # reference reader, returns (kind, item, version, smoke_dict) with the
+    # same structure as the JSON files
+    reader = Reader(data)
+    (magic,) = reader.unpack('4s')
+    if magic != MAGIC:
+        raise ValueError(f'not a smoke file: {magic!r}')
+    format_version, kind = reader.unpack('HB')
+    if format_version != FORMAT_VERSION:
+        raise ValueError(f'unsupported smoke format version {format_version}')
+    item = reader.string()
+    version = reader.string()
+
+    if kind == KIND_MOVING:
+        n_directions, n_frames = reader.unpack('BI')
+        smoke_dict = { "direction_frames": [] }
+        for _ in range(n_directions):
+            (direction,) = reader.unpack('B')
+            emitter_coords = pair_up(reader.floats(n_frames * 2))
+            smoke_directions = pair_up(reader.floats(n_frames * 2))
+            smoke_dict["direction_frames"].append({
+                "pair": {
+                    "diagonal_pair": direction_names[direction]
+                },
+                "frames": [
+                    {
+                        "frame": frame,
+                        "emitter_coords": emitter_coords[frame],
+                        "smoke_direction": smoke_directions[frame],
+                    }
+                    for frame in range(n_frames)
+                ]
+            })
+    elif kind == KIND_STATIC:
+        (n_degrees,) = reader.unpack('B')
+        smoke_dict = {}
+        for _ in range(n_degrees):
+            degree, n_emitters = reader.unpack('HI')
+            smoke_dict[f'{DEGREE_PREFIX}{degree}'] = pair_up(reader.floats(n_emitters * 2))
+    else:
+        raise ValueError(f'unknown smoke kind {kind}')
+    return kind, item, version, smoke_dict
+
+def to_float32(value):
+    if isinstance(value, dict):
+        return {key: to_float32(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_float32(item) for item in value]
+    if isinstance(value, float):
+        return struct.unpack('<f', struct.pack('<f', value))[0]
+    return value
+
+def verify_round_trip(data, smoke_dict, direction_names=None):
+    # the binary file must decode to the JSON dict rounded to float32
+    _kind, _item, _version, decoded = decode(data, direction_names)
+    if decoded != to_float32(smoke_dict):
+        raise ValueError('binary smoke data does not match the JSON data')
+    print('binary round trip: ok')
@@ -0,0 +1,139 @@
+import numpy as np
+from numpy.polynomial import chebyshev
+
+
+# Fits the per frame emitter_coords and smoke_direction of each direction
+# with the lowest order curve within a tolerance, so the game stores a few
+# coefficients and can evaluate any frame, fractions included.
+# fourier: c0 + sum(a_k cos(2 pi k t) + b_k sin(2 pi k t)), t = frame / n_frames,
+#   for looping tracks. Coefficients: c0, a_1, b_1, a_2, b_2...
+# polynomial: Chebyshev series in x = 2 frame / (n_frames - 1) - 1,
+#   for tracks that go somewhere. Coefficients: c_0, c_1, c_2...
+# samples: the track as exported, for the tracks no curve fits. "samples"
+#   replaces "coefficients", linearly interpolated between frames.
+CURVES_VERSION = 2
+KIND_FOURIER = "fourier"
+KIND_POLYNOMIAL = "polynomial"
+KIND_SAMPLES = "samples"
+KINDS = [KIND_FOURIER, KIND_POLYNOMIAL]
+TRACKS = ["emitter_coords", "smoke_direction"]
+# at most one coefficient per this many samples: near the interpolating order
+# a curve only meets the tolerance on the frames and oscillates between them
+SAMPLES_PER_COEFFICIENT = 3
+
+def get_max_order(kind, n_frames):
+    max_coefficients = max(n_frames // SAMPLES_PER_COEFFICIENT, 1)
+    if kind == KIND_FOURIER:
+        return (max_coefficients - 1) // 2
+    return max_coefficients - 1
+
+def get_order(kind, n_coefficients):
+    if kind == KIND_FOURIER:
+        return (n_coefficients - 1) // 2
+    return n_coefficients - 1
+
+def get_basis(kind, frames, n_frames, order):
+    frames = np.asarray(frames, dtype=np.float64)
+    if kind == KIND_FOURIER:
+        angles = 2 * np.pi * frames / n_frames
+        columns = [np.ones_like(angles)]
+        for harmonic in range(1, order + 1):
+            columns += [np.cos(harmonic * angles), np.sin(harmonic * angles)]
+        return np.stack(columns, axis=-1)
+    x = 2 * frames / max(n_frames - 1, 1) - 1
+    return chebyshev.chebvander(x, order)
+
+def evaluate_curve(curve, frames):
+    # reference evaluator: (len(frames), 2) values of the curve at frames,
+    # frame 0 being the first sample, in the same units as the samples
+    if curve["kind"] == KIND_SAMPLES:
+        samples = np.array(curve["samples"], dtype=np.float64)
+        sample_frames = np.arange(curve["n_frames"])
+        frames = np.atleast_1d(frames)
+        return np.stack([np.interp(frames, sample_frames, samples[:, axis]) for axis in range(2)], axis=-1)
+    coefficients = np.array(curve["coefficients"], dtype=np.float64)
+    order = get_order(curve["kind"], coefficients.shape[1])
+    basis = get_basis(curve["kind"], np.atleast_1d(frames), curve["n_frames"], order)
+    return basis @ coefficients.T
+
+def get_max_error(samples, fitted):
+    return float(np.linalg.norm(fitted - samples, axis=1).max())
+
+def fit_kind(kind, samples, tolerance):
+    # lowest order within tolerance, or the highest one allowed
+    n_frames = samples.shape[0]
+    frames = np.arange(n_frames)
+    for order in range(get_max_order(kind, n_frames) + 1):
+        basis = get_basis(kind, frames, n_frames, order)
+        coefficients = np.linalg.lstsq(basis, samples, rcond=None)[0]
+        max_error = get_max_error(samples, basis @ coefficients)
+        if max_error <= tolerance:
+            break
+    return {
+        "kind": kind,
+        "n_frames": n_frames,
+        # one list per axis, x then y
+        "coefficients": coefficients.T.tolist(),
+        "max_error": max_error,
+    }
+
+def fit_track(samples, tolerance):
+    # samples: (n_frames, 2), keeps the kind with the fewest coefficients,
+    # or the samples when no curve is within tolerance
+    samples = np.asarray(samples, dtype=np.float64)
+    candidates = [fit_kind(kind, samples, tolerance) for kind in KINDS]
+    within_tolerance = [curve for curve in candidates if curve["max_error"] <= tolerance]
+    if within_tolerance:
+        return min(within_tolerance, key=lambda curve: (len(curve["coefficients"][0]), curve["max_error"]))
+    return {
+        "kind": KIND_SAMPLES,
+        "n_frames": samples.shape[0],
+        "samples": samples.tolist(),
+        "max_error": 0.0,
+    }
+
+def count_values(curve):
+    if curve["kind"] == KIND_SAMPLES:
+        return curve["n_frames"] * 2
+    return len(curve["coefficients"][0]) * 2
+
+def fit_smoke_dict(smoke_dict, tolerances):
+    # tolerances: largest distance between a sample and its curve, per track
+    curve_frames = []
+    for direction_frame in smoke_dict["direction_frames"]:
+        curve_frame = {"pair": direction_frame["pair"]}
+        for track in TRACKS:
+            samples = [frame[track] for frame in direction_frame["frames"]]
+            curve_frame[track] = fit_track(samples, tolerances[track])
+        curve_frames.append(curve_frame)
+    return {"version": CURVES_VERSION, "curve_frames": curve_frames}
+
+def verify_curves(curves_dict, smoke_dict):
+    # max error of the evaluated curves against the samples, per direction and track
+    report = {}
+    for curve_frame, direction_frame in zip(curves_dict["curve_frames"], smoke_dict["direction_frames"]):
+        pair = curve_frame["pair"]["diagonal_pair"]
+        report[pair] = {}
+        for track in TRACKS:
+            samples = np.array([frame[track] for frame in direction_frame["frames"]], dtype=np.float64)
+            fitted = evaluate_curve(curve_frame[track], np.arange(samples.shape[0]))
+            report[pair][track] = get_max_error(samples, fitted)
+    return report
+
+def print_report(curves_dict, report):
+    n_samples = 0
+    n_coefficients = 0
+    for curve_frame in curves_dict["curve_frames"]:
+        pair = curve_frame["pair"]["diagonal_pair"]
+        for track in TRACKS:
+            curve = curve_frame[track]
+            n_samples += curve["n_frames"] * 2
+            n_coefficients += count_values(curve)
+            if curve["kind"] == KIND_SAMPLES:
+                print(f'{pair} {track}: no curve within tolerance, samples kept')
+                continue
+            print(
+                f'{pair} {track}: {curve["kind"]}, {len(curve["coefficients"][0])} coefficients, '
+                f'max error {report[pair][track]:.5f}'
+            )
+    print(f'{n_coefficients} values instead of {n_samples} samples')
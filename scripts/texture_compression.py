@@ -0,0 +1,321 @@
+import common
+import numpy as np
+import os
+import struct
+import time
+from PIL import Image
+
+
+# BC3 (DXT5): 4x4 blocks of 16 bytes, 8 of interpolated alpha and 8 of
+# 4 colour BC1. BC7 and KTX2 would need a far bigger encoder than this
+# NumPy one, BC3 in DDS is read by every engine and GPU.
+BLOCK_SIZE = 4
+BLOCK_BYTES = 16
+DDS_EXTENSION = "dds"
+QUALITY_FAST = "fast"
+QUALITY_NORMAL = "normal"
+QUALITY_HIGH = "high"
+QUALITIES = [QUALITY_FAST, QUALITY_NORMAL, QUALITY_HIGH]
+# refinement passes of the colour endpoints, per quality
+REFINE_ITERATIONS = {QUALITY_FAST: 0, QUALITY_NORMAL: 0, QUALITY_HIGH: 2}
+POWER_ITERATIONS = 8
+
+DDS_MAGIC = b'DDS '
+DDS_HEADER_SIZE = 124
+DDS_PIXELFORMAT_SIZE = 32
+DDSD_CAPS = 0x1
+DDSD_HEIGHT = 0x2
+DDSD_WIDTH = 0x4
+DDSD_PIXELFORMAT = 0x1000
+DDSD_MIPMAPCOUNT = 0x20000
+DDSD_LINEARSIZE = 0x80000
+DDPF_FOURCC = 0x4
+DDSCAPS_COMPLEX = 0x8
+DDSCAPS_TEXTURE = 0x1000
+DDSCAPS_MIPMAP = 0x400000
+FOURCC_DXT5 = b'DXT5'
+
+def to_blocks(pixels):
+    # (height, width, 4) to (n_blocks, 16, 4), padding the edges by repetition
+    height, width = pixels.shape[:2]
+    padded_height = -(-height // BLOCK_SIZE) * BLOCK_SIZE
+    padded_width = -(-width // BLOCK_SIZE) * BLOCK_SIZE
+    if (padded_height, padded_width) != (height, width):
+        pixels = np.pad(pixels, ((0, padded_height - height), (0, padded_width - width), (0, 0)), mode='edge')
+    blocks = pixels.reshape(padded_height // BLOCK_SIZE, BLOCK_SIZE, padded_width // BLOCK_SIZE, BLOCK_SIZE, 4)
+    return blocks.transpose(0, 2, 1, 3, 4).reshape(-1, BLOCK_SIZE * BLOCK_SIZE, 4)
+
+def from_blocks(blocks, width, height):
+    n_block_rows = -(-height // BLOCK_SIZE)
+    n_block_cols = -(-width // BLOCK_SIZE)
+    pixels = blocks.reshape(n_block_rows, n_block_cols, BLOCK_SIZE, BLOCK_SIZE, 4)
+    pixels = pixels.transpose(0, 2, 1, 3, 4).reshape(n_block_rows * BLOCK_SIZE, n_block_cols * BLOCK_SIZE, 4)
+    return pixels[:height, :width]
+
+def pack_565(colors):
+    colors = np.clip(np.rint(colors), 0, 255).astype(np.uint16)
+    return ((colors[..., 0] >> 3) << 11) | ((colors[..., 1] >> 2) << 5) | (colors[..., 2] >> 3)
+
+def unpack_565(packed):
+    packed = packed.astype(np.uint16)
+    red = (packed >> 11) & 0x1f
+    green = (packed >> 5) & 0x3f
+    blue = packed & 0x1f
+    return np.stack([
+        (red << 3) | (red >> 2),
+        (green << 2) | (green >> 4),
+        (blue << 3) | (blue >> 2),
+    ], axis=-1).astype(np.float32)
+
+def get_color_palette(color0, color1):
+    # (n_blocks, 3) endpoints to (n_blocks, 4, 3), in index order
+    return np.stack([
+        color0,
+        color1,
+        (2 * color0 + color1) / 3,
+        (color0 + 2 * color1) / 3,
+    ], axis=1)
+
+def get_alpha_palette(alpha0, alpha1):
+    # alpha0 > alpha1: 6 interpolated values, else 4 and the explicit 0 and 255
+    alpha0 = alpha0.astype(np.float32)[:, None]
+    alpha1 = alpha1.astype(np.float32)[:, None]
+    steps = np.arange(1, 7, dtype=np.float32)[None, :]
+    eight = np.concatenate([alpha0, alpha1, ((7 - steps) * alpha0 + steps * alpha1) / 7], axis=1)
+    steps = np.arange(1, 5, dtype=np.float32)[None, :]
+    six = np.concatenate([
+        alpha0,
+        alpha1,
+        ((5 - steps) * alpha0 + steps * alpha1) / 5,
+        np.zeros_like(alpha0),
+        np.full_like(alpha0, 255),
+    ], axis=1)
+    return np.where(alpha0 > alpha1, eight, six)
+
+def nearest_indices(values, palette):
+    # values (n_blocks, 16, channels), palette (n_blocks, n_entries, channels)
+    distances = ((values[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(axis=-1)
+    indices = distances.argmin(axis=-1)
+    errors = np.take_along_axis(distances, indices[..., None], axis=-1)[..., 0]
+    return indices, errors
+
+def masked_extremes(values, mask):
+    low = np.where(mask, values, np.inf).min(axis=1)
+    high = np.where(mask, values, -np.inf).max(axis=1)
+    return low, high
+
+def get_color_mask(blocks):
+    # the colour of transparent pixels is never seen, blocks without
+    # any visible pixel still get a valid encoding from all of them
+    visible = blocks[:, :, 3] > 0
+    return visible | ~visible.any(axis=1, keepdims=True)
+
+def bounding_box_endpoints(colors, mask):
+    low, high = masked_extremes(colors, mask[..., None])
+    return high, low
+
+def principal_axis_endpoints(colors, mask):
+    weights = mask[..., None].astype(np.float32)
+    mean = (colors * weights).sum(axis=1) / weights.sum(axis=1)
+    centered = (colors - mean[:, None, :]) * weights
+    covariance = np.einsum('nki,nkj->nij', centered, centered)
+    axis = np.ones((colors.shape[0], 3), dtype=np.float32)
+    for _ in range(POWER_ITERATIONS):
+        axis = np.einsum('nij,nj->ni', covariance, axis)
+        norm = np.linalg.norm(axis, axis=1, keepdims=True)
+        axis = np.where(norm > 1e-8, axis / np.maximum(norm, 1e-8), 0)
+    projections = np.einsum('nki,ni->nk', colors - mean[:, None, :], axis)
+    low, high = masked_extremes(projections, mask)
+    return mean + axis * high[:, None], mean + axis * low[:, None]
+
+def fit_color_endpoints(colors, mask, indices, color0, color1):
+    # least squares endpoints for the chosen indices
+    weights_of_color1 = np.array([0, 1, 1 / 3, 2 / 3], dtype=np.float32)[indices]
+    weights_of_color0 = 1 - weights_of_color1
+    weights = mask.astype(np.float32)
+    a00 = (weights * weights_of_color0 ** 2).sum(axis=1)
+    a01 = (weights * weights_of_color0 * weights_of_color1).sum(axis=1)
+    a11 = (weights * weights_of_color1 ** 2).sum(axis=1)
+    b0 = ((weights * weights_of_color0)[..., None] * colors).sum(axis=1)
+    b1 = ((weights * weights_of_color1)[..., None] * colors).sum(axis=1)
+    determinant = a00 * a11 - a01 * a01
+    solvable = (np.abs(determinant) > 1e-6)[:, None]
+    safe_determinant = np.where(solvable[:, 0], determinant, 1)[:, None]
+    fitted0 = (a11[:, None] * b0 - a01[:, None] * b1) / safe_determinant
+    fitted1 = (a00[:, None] * b1 - a01[:, None] * b0) / safe_determinant
+    return np.where(solvable, fitted0, color0), np.where(solvable, fitted1, color1)
+
+def quantize_color_endpoints(colors, mask, color0, color1):
+    packed0 = pack_565(color0)
+    packed1 = pack_565(color1)
+    # keep packed0 > packed1, the 4 colour order of BC1, for every decoder
+    swap = packed0 < packed1
+    packed0, packed1 = np.where(swap, packed1, packed0), np.where(swap, packed0, packed1)
+    palette = get_color_palette(unpack_565(packed0), unpack_565(packed1))
+    indices, errors = nearest_indices(colors, palette)
+    return packed0, packed1, indices, (errors * mask).sum(axis=1)
+
+def encode_color(blocks, quality):
+    colors = blocks[:, :, :3].astype(np.float32)
+    mask = get_color_mask(blocks)
+    if quality == QUALITY_FAST:
+        color0, color1 = bounding_box_endpoints(colors, mask)
+    else:
+        color0, color1 = principal_axis_endpoints(colors, mask)
+    packed0, packed1, indices, errors = quantize_color_endpoints(colors, mask, color0, color1)
+
+    for _ in range(REFINE_ITERATIONS[quality]):
+        color0, color1 = fit_color_endpoints(colors, mask, indices, unpack_565(packed0), unpack_565(packed1))
+        candidate = quantize_color_endpoints(colors, mask, color0, color1)
+        better = candidate[3] < errors
+        packed0 = np.where(better, candidate[0], packed0)
+        packed1 = np.where(better, candidate[1], packed1)
+        indices = np.where(better[:, None], candidate[2], indices)
+        errors = np.where(better, candidate[3], errors)
+
+    # equal endpoints only have one colour, index 0
+    indices = np.where((packed0 == packed1)[:, None], 0, indices)
+    return packed0, packed1, indices
+
+def encode_alpha(blocks, quality):
+    alphas = blocks[:, :, 3:4].astype(np.float32)
+    alpha0 = blocks[:, :, 3].max(axis=1)
+    alpha1 = blocks[:, :, 3].min(axis=1)
+    indices, errors = nearest_indices(alphas, get_alpha_palette(alpha0, alpha1)[..., None])
+    if quality != QUALITY_FAST:
+        # the 4 value mode spends its endpoints on the partial alphas only,
+        # fully transparent and opaque pixels use the explicit 0 and 255
+        partial = (blocks[:, :, 3] > 0) & (blocks[:, :, 3] < 255)
+        low, high = masked_extremes(blocks[:, :, 3].astype(np.float32), partial)
+        low = np.where(np.isfinite(low), low, 0).astype(np.uint8)
+        high = np.where(np.isfinite(high), high, 0).astype(np.uint8)
+        candidate_indices, candidate_errors = nearest_indices(alphas, get_alpha_palette(low, high)[..., None])
+        better = candidate_errors.sum(axis=1) < errors.sum(axis=1)
+        alpha0 = np.where(better, low, alpha0)
+        alpha1 = np.where(better, high, alpha1)
+        indices = np.where(better[:, None], candidate_indices, indices)
+    return alpha0, alpha1, indices
+
+def pack_blocks(alpha0, alpha1, alpha_indices, packed0, packed1, color_indices):
+    n_blocks = alpha0.shape[0]
+    shifts = np.arange(16, dtype=np.uint64)
+    alpha_bits = (alpha_indices.astype(np.uint64) << (3 * shifts)).sum(axis=1, dtype=np.uint64)
+    color_bits = (color_indices.astype(np.uint64) << (2 * shifts)).sum(axis=1, dtype=np.uint64).astype(np.uint32)
+    data = np.zeros((n_blocks, BLOCK_BYTES), dtype=np.uint8)
+    data[:, 0] = alpha0
+    data[:, 1] = alpha1
+    data[:, 2:8] = alpha_bits.astype('<u8').view(np.uint8).reshape(n_blocks, 8)[:, :6]
+    data[:, 8:10] = packed0.astype('<u2').view(np.uint8).reshape(n_blocks, 2)
+    data[:, 10:12] = packed1.astype('<u2').view(np.uint8).reshape(n_blocks, 2)
+    data[:, 12:16] = color_bits.astype('<u4').view(np.uint8).reshape(n_blocks, 4)
+    return data.tobytes()
+
+def encode_bc3(pixels, quality=QUALITY_NORMAL):
+    # pixels: (height, width, 4) uint8 RGBA, returns the BC3 blocks in row order
+    blocks = to_blocks(pixels)
+    alpha0, alpha1, alpha_indices = encode_alpha(blocks, quality)
+    packed0, packed1, color_indices = encode_color(blocks, quality)
+    return pack_blocks(alpha0, alpha1, alpha_indices, packed0, packed1, color_indices)
+
+def decode_bc3(data, width, height):
+    blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, BLOCK_SIZE * BLOCK_SIZE)
+    n_blocks = blocks.shape[0]
+    alpha_bits = np.zeros((n_blocks, 8), dtype=np.uint8)
+    alpha_bits[:, :6] = blocks[:, 2:8]
+    alpha_bits = alpha_bits.view('<u8')[:, 0]
+    shifts = np.arange(16, dtype=np.uint64)
+    alpha_indices = ((alpha_bits[:, None] >> (3 * shifts)) & 7).astype(np.intp)
+    alphas = np.take_along_axis(get_alpha_palette(blocks[:, 0], blocks[:, 1]), alpha_indices, axis=1)
+
+    packed0 = blocks[:, 8:10].copy().view('<u2')[:, 0]
+    packed1 = blocks[:, 10:12].copy().view('<u2')[:, 0]
+    color_bits = blocks[:, 12:16].copy().view('<u4')[:, 0].astype(np.uint64)
+    color_indices = ((color_bits[:, None] >> (2 * shifts)) & 3).astype(np.intp)
+    palette = get_color_palette(unpack_565(packed0), unpack_565(packed1))
+    colors = np.take_along_axis(palette, color_indices[..., None], axis=1)
+
+    decoded = np.concatenate([colors, alphas[..., None]], axis=-1)
+    return from_blocks(np.clip(np.rint(decoded), 0, 255).astype(np.uint8), width, height)
+
+def get_level_size(width, height):
+    return -(-width // BLOCK_SIZE) * -(-height // BLOCK_SIZE) * BLOCK_BYTES
+
+def make_dds_header(width, height, n_levels=1):
+    flags = DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT | DDSD_LINEARSIZE
+    caps = DDSCAPS_TEXTURE
+    if n_levels > 1:
+        flags |= DDSD_MIPMAPCOUNT
+        caps |= DDSCAPS_COMPLEX | DDSCAPS_MIPMAP
+    return b''.join([
+        DDS_MAGIC,
+        struct.pack('<7I', DDS_HEADER_SIZE, flags, height, width, get_level_size(width, height), 0, n_levels),
+        struct.pack('<11I', *[0] * 11),
+        struct.pack('<2I4s5I', DDS_PIXELFORMAT_SIZE, DDPF_FOURCC, FOURCC_DXT5, 0, 0, 0, 0, 0),
+        struct.pack('<5I', caps, 0, 0, 0, 0),
+    ])
+
+def write_dds(dds_path, width, height, levels):
+    # levels: the BC3 data of the full size image first, then of each mip
+    temp_path = f'{dds_path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(make_dds_header(width, height, len(levels)))
+        for level in levels:
+            f.write(level)
+    os.replace(temp_path, dds_path)
+
+def read_dds(dds_path):
+    # returns width, height and the BC3 data of the full size image
+    with open(dds_path, 'rb') as f:
+        header = f.read(len(DDS_MAGIC) + DDS_HEADER_SIZE)
+        if header[:len(DDS_MAGIC)] != DDS_MAGIC:
+            raise ValueError(f'{dds_path} is not a DDS file')
+        _size, _flags, height, width = struct.unpack_from('<4I', header, len(DDS_MAGIC))
+        fourcc = struct.unpack_from('<4s', header, len(DDS_MAGIC) + 72 + 8)[0]
+        if fourcc != FOURCC_DXT5:
+            raise ValueError(f'{dds_path} is {fourcc}, not {FOURCC_DXT5}')
+        return width, height, f.read(get_level_size(width, height))
+
+def compare(original, decoded):
+    # error report of the decoded texture against the original pixels, the
+    # colour of fully transparent pixels is never seen so it is not counted
+    difference = original.astype(np.float64) - decoded.astype(np.float64)
+    difference[original[:, :, 3] == 0, :3] = 0
+    squared = difference ** 2
+    rmse = np.sqrt(squared.mean(axis=(0, 1)))
+    mse = squared.mean()
+    return {
+        "rmse": {channel: round(float(value), 3) for channel, value in zip('rgba', rmse)},
+        "max_error": int(np.abs(difference).max()),
+        "psnr": round(float(10 * np.log10(255 ** 2 / mse)), 2) if mse > 0 else None,
+    }
+
+def get_dds_path(image_path):
+    return f'{os.path.splitext(image_path)[0]}.{DDS_EXTENSION}'
+
+def compress_image(image_path, quality=QUALITY_NORMAL, mip_levels=()):
+    # writes the BC3 DDS next to the png and prints how far it is from it.
+    # mip_levels: pixels of the mips stored after the full size image
+    dds_path = get_dds_path(image_path)
+    with Image.open(image_path) as image:
+        pixels = np.asarray(image.convert('RGBA'))
+    height, width = pixels.shape[:2]
+    start = time.perf_counter()
+    with common.span('encode_bc3', image_path=image_path, quality=quality):
+        data = encode_bc3(pixels, quality)
+        levels = [data] + [encode_bc3(mip_pixels, quality) for mip_pixels in mip_levels]
+    encode_seconds = time.perf_counter() - start
+    write_dds(dds_path, width, height, levels)
+
+    _width, _height, written = read_dds(dds_path)
+    report = compare(pixels, decode_bc3(written, width, height))
+    report.update({
+        "quality": quality,
+        "n_levels": len(levels),
+        "encode_seconds": round(encode_seconds, 3),
+        "png_bytes": os.path.getsize(image_path),
+        "dds_bytes": os.path.getsize(dds_path),
+        "rgba8_bytes": width * height * 4,
+    })
+    print(f'dds_path: {dds_path}')
+    print(f'report: {report}')
+    return dds_path, report
@@ -0,0 +1,211 @@
+import argparse
+import build
+import common
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import time
+
+
+BLEND_EXTENSION = ".blend"
+# inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+def get_models_dir():
+    blender_dir = common.get_blender_dir()
+    return blender_dir.joinpath(f'{common.MODELS}/{common.WORLD_MAP}/')
+
+def is_blend_file(path):
+    # skips the .blend1 backups and the .blend@ files Blender saves through
+    return path.endswith(BLEND_EXTENSION)
+
+class InotifyWatcher:
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        self.add_tree(root)
+
+    def add_tree(self, root):
+        for dir_path, _dirs, _files in os.walk(root):
+            watch = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if watch < 0:
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed on {dir_path}')
+            self.dirs[watch] = dir_path
+
+    def read_events(self):
+        changed = set()
+        data = os.read(self.fd, READ_SIZE)
+        offset = 0
+        while offset < len(data):
+            watch, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                print('inotify queue overflow, some changes were missed')
+                continue
+            if watch not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[watch], name)
+            if mask & IN_ISDIR:
+                # new version folders are watched too, with the files already in them
+                self.add_tree(path)
+                changed.update(
+                    os.path.join(root, file) for root, _dirs, files in os.walk(path) for file in files
+                )
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.add(path)
+        return changed
+
+    def wait_for_changes(self, debounce):
+        # blocks until something changes, then collects the changes until
+        # none come for debounce seconds, so one save is one rebuild
+        select.select([self.fd], [], [])
+        changed = self.read_events()
+        while select.select([self.fd], [], [], debounce)[0]:
+            changed |= self.read_events()
+        return changed
+
+class PollingWatcher:
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for root, _dirs, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def wait_for_changes(self, debounce):
+        changed = set()
+        while True:
+            time.sleep(self.interval if not changed else debounce)
+            snapshot = self.scan()
+            new_changes = {path for path, stat in snapshot.items() if self.snapshot.get(path) != stat}
+            self.snapshot = snapshot
+            if changed and not new_changes:
+                return changed
+            changed |= new_changes
+
+def make_watcher(root, poll, interval):
+    if not poll:
+        try:
+            return InotifyWatcher(root)
+        except (AttributeError, OSError) as error:
+            # no inotify outside Linux, or no watches left
+            print(f'inotify unavailable ({error}), polling every {interval}s')
+    return PollingWatcher(root, interval)
+
+def get_changed_unit(path, models_dir):
+    # (item, version or filename, unit) rendered from path, with the naming
+    # rules of the render scripts: the last 5 chars of an animation file are
+    # its direction, the last char of a housing file its variety, and a
+    # single .blend model is every degree (unit None)
+    relative = pathlib.Path(path).relative_to(models_dir)
+    item = relative.parts[0]
+    if item not in build.PIPELINES:
+        return None
+    name = pathlib.Path(path).stem
+    stages = build.PIPELINES[item]
+    if len(relative.parts) == 3:
+        if build.STAGE_HOUSING in stages:
+            return item, relative.parts[1], name[-1:]
+        return item, relative.parts[1], name[-5:]
+    if len(relative.parts) == 2:
+        return item, name, None
+    return None
+
+def select_tasks(tasks, changed_paths):
+    # the tasks reading a changed file, and every task after them. The
+    # dependencies outside the selection are already built.
+    changed_paths = {os.path.normpath(path) for path in changed_paths}
+    selected = {
+        name for name, task in tasks.items()
+        if any(os.path.normpath(input) in changed_paths for input in task.inputs)
+    }
+    added = True
+    while added:
+        added = False
+        for name, task in tasks.items():
+            if name not in selected and any(dependency in selected for dependency in task.dependencies):
+                selected.add(name)
+                added = True
+    return {
+        name: build.Task(
+            task.name,
+            task.command,
+            task.inputs,
+            task.outputs,
+            [dependency for dependency in task.dependencies if dependency in selected],
+            task.render_profile,
+        )
+        for name, task in tasks.items() if name in selected
+    }
+
+def rebuild(changed_paths, models_dir, items, n_workers, n_frames, render_profile):
+    changed_units = []
+    for path in sorted(changed_paths):
+        changed_unit = get_changed_unit(path, models_dir)
+        if changed_unit and (not items or changed_unit[0] in items):
+            item, model, unit = changed_unit
+            print(f'changed {item}/{model}: {unit or "every degree"}')
+            changed_units.append(changed_unit)
+    if not changed_units:
+        return
+    start = time.perf_counter()
+    # planned again on every change, files may have been added; the render
+    # tasks use the render cache, so only the changed units are rendered
+    tasks = build.make_tasks(sorted(set(item for item, _model, _unit in changed_units)), n_frames, render_profile)
+    tasks = select_tasks(tasks, changed_paths)
+    done, failed, skipped = build.run_tasks(tasks, n_workers, force=False, dry_run=False)
+    print(f'rebuilt in {time.perf_counter() - start:.1f}s, done: {len(done)}, failed: {len(failed)}, skipped: {len(skipped)}')
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('items', type=str, nargs='*', help='items to watch, all of them if empty')
+    parser.add_argument('--n_frames', type=int, default=24)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of tasks running at the same time')
+    parser.add_argument('--poll', action='store_true', help='poll the models tree instead of using inotify')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between two polls')
+    parser.add_argument('--debounce', type=float, default=0.5, help='seconds without changes before rebuilding')
+    parser.add_argument('--render_profile', type=str, choices=list(common.RENDER_PROFILES), default=common.RENDER_PROFILE_FINAL, help='preview renders fast, and its sheets are never published')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    models_dir = get_models_dir()
+    watcher = make_watcher(models_dir, args.poll, args.interval)
+    print(f'watching {models_dir} with {type(watcher).__name__}')
+    try:
+        while True:
+            changed_paths = [path for path in watcher.wait_for_changes(args.debounce) if is_blend_file(path)]
+            rebuild(changed_paths, models_dir, args.items, args.workers, args.n_frames, args.render_profile)
+    except KeyboardInterrupt:
+        print('stopped')
+
+
+if __name__ == "__main__":
+    main()
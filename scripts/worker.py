@@ -0,0 +1,96 @@
+import json
+import os
+import pathlib
+import sys
+
+# blender -P does not put the script directory on sys.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+import pool
+
+
+KIND_EXPORT_MOVING_SMOKE = "export_moving_smoke"
+KIND_EXPORT_STATIC_SMOKE = "export_static_smoke"
+KIND_RENDER_CONSTRUCTION = "render_construction"
+KIND_RENDER_DIRECTION = "render_direction"
+
+def get_render_settings(job):
+    if not job.get('render_settings'):
+        return None
+    return common.RenderSettings.from_dict(job['render_settings'])
+
+def export_moving_smoke(job):
+    import export_moving_smoke
+
+    sprite = common.SpriteSize(job['item'])
+    return export_moving_smoke.extract_direction_frame(
+        job['file'],
+        job['n_frames'],
+        sprite,
+        job['vectorized'],
+    )
+
+def export_static_smoke(job):
+    import export_static_smoke
+
+    model_path = common.get_model_path(job['item'], job['filename'])
+    return export_static_smoke.extract_dict_from_target_files(model_path, job['item'])
+
+def render_construction(job):
+    import construction
+
+    output_dir = construction.render_animations(
+        job['item'],
+        job['model_path'],
+        pathlib.Path(job['output_dir']),
+        job['degree'],
+        True,
+        job['n_frames'],
+        job['collection_names'],
+        reveal=job['reveal'],
+        frame_start=job.get('frame_start', 1),
+        frame_end=job.get('frame_end'),
+        render_settings=get_render_settings(job),
+    )
+    return {'output_dir': str(output_dir)}
+
+def render_direction(job):
+    import render_animation
+
+    output_dir = render_animation.render_blender_file(
+        job['file'],
+        pathlib.Path(job['root_output_dir']),
+        True,
+        job['n_frames'],
+        frame_start=job.get('frame_start', 1),
+        frame_end=job.get('frame_end'),
+        render_settings=get_render_settings(job),
+        save_source=job.get('save_source', True),
+    )
+    return {'output_dir': str(output_dir)}
+
+JOBS = {
+    KIND_EXPORT_MOVING_SMOKE: export_moving_smoke,
+    KIND_EXPORT_STATIC_SMOKE: export_static_smoke,
+    KIND_RENDER_CONSTRUCTION: render_construction,
+    KIND_RENDER_DIRECTION: render_direction,
+}
+
+def run_job(job):
+    print(f'job: {job.get("name", "")} ({job["kind"]})')
+    return JOBS[job['kind']](job)
+
+
+def main():
+    # the job is always the last argument, both for `python worker.py <job>`
+    # and for `blender -b -P worker.py -- <job>`
+    job = json.loads(sys.argv[-1])
+    common.set_trace_tags(job=job.get('name', ''))
+    with common.span(job['kind']):
+        result = run_job(job)
+    common.write_trace(f'worker_{job["kind"]}')
+    print(f'{pool.RESULT_PREFIX}{json.dumps(result)}')
+
+
+if __name__ == "__main__":
+    main()